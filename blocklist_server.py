@@ -0,0 +1,200 @@
+"""
+Blocklist server
+
+Local HTTP service that scores a GreedyBear dump once, keeps the full ranking of every
+model in memory and serves any top-k prefix of it on demand. Publishing a model at a new
+size therefore costs nothing. Like the evaluated and published feeds, the rankings leave
+out the IOCs GreedyBear does not list (see models.feed.exclusions). Responses carry an
+ETag derived from the scored dump, the model artifacts and --cidr-max-extra, so polling
+clients that already have the current list get a 304 without a body, and are gzip
+compressed if the client accepts it.
+
+Usage:
+    python blocklist_server.py -s gbdump.json [--port 8766]
+
+Endpoints:
+    GET /feeds         Available feeds and their maximum sizes.
+    GET /feeds/<feed>  Top-k of a feed. Query parameters:
+                       size    number of IPs (default: 5000)
+                       format  txt (one IP per line), cidr (CIDR rules, see --cidr-max-extra)
+                               or bin (binary blocklist, see models/blocklist_lookup.py)
+"""
+import argparse
+import gzip
+import hashlib
+import json
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from evaluate_single_day import calculate_scores
+from greedybear_utils import read_dump
+from models.base_model import Model
+from models.blocklist import cidr_blocks, encode_binary
+from models.consts import DEFAULT_K, NON_SCORING_KEYS
+from models.feed import Feed, exclusions
+from models.model_definitions import MODEL_DEFINITIONS
+from models.score_cache import ScoreCache, dump_hash
+from models.utils import get_features, ipv4_to_int
+
+CONTENT_TYPES = {
+    "txt": "text/plain",
+    "cidr": "text/plain",
+    "bin": "application/octet-stream",
+}
+RESPONSE_CACHE_SIZE = 256
+GZIP_LEVEL = 6
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Whether an If-None-Match header lists the ETag, compared weakly as RFC 9110 requires for If-None-Match."""
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+class RankingStore:
+    """
+    Full rankings of all models for one scored dump.
+
+    Attributes:
+        version (str): Hash of the scored dump, the model artifacts and the CIDR setting, part of every ETag
+        date (str): Date of the scored dump
+        rankings (dict): Maps the feed's slug to the model name, its ranked IPs and their integer form
+    """
+
+    def __init__(self, file_path: str, cidr_max_extra: int = 0):
+        dump_key = dump_hash(file_path, exclude_mass_scanners=False)
+        self.cidr_max_extra = cidr_max_extra
+        iocs = read_dump(file_path)
+        self.date = max(ioc["last_seen"] for ioc in iocs)
+        scoring_df = get_features(iocs, self.date)
+        models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS if d["sort_key"] not in NON_SCORING_KEYS]
+        calculate_scores(models, scoring_df, cache=ScoreCache(dump_key))
+        # retrained models or another CIDR setting change the served lists of the same dump
+        digest = hashlib.sha256(dump_key.encode())
+        for model in models:
+            digest.update(model.cache_key().encode())
+        digest.update(str(cidr_max_extra).encode())
+        self.version = digest.hexdigest()[:16]
+        self.rankings = {}
+        excluded = exclusions(scoring_df, self.date)
+        for model in models:
+            order = Feed(model.name, data=scoring_df, size=len(scoring_df), sort_key=model.sort_key).order
+            if model.name in excluded:
+                # removing rows keeps the order of the others, like Feed.exclude, which needs evaluation data
+                order = order[~excluded[model.name][order]]
+            ips = scoring_df["value"].to_numpy()[order]
+            self.rankings[model.name.replace(" ", "_").lower()] = (model.name, model.sort_key, ips, ipv4_to_int(ips))
+        self.render = lru_cache(maxsize=RESPONSE_CACHE_SIZE)(self.render)
+        self.render_gzip = lru_cache(maxsize=RESPONSE_CACHE_SIZE)(self.render_gzip)
+
+    def etag(self, slug: str, size: int, fmt: str) -> str:
+        return f'"{self.version}-{slug}-{size}-{fmt}"'
+
+    def render(self, slug: str, size: int, fmt: str) -> bytes:
+        name, sort_key, ips, ints = self.rankings[slug]
+        if fmt == "txt":
+            return "\n".join(ips[:size]).encode()
+        if fmt == "cidr":
+            return "\n".join(cidr_blocks(ints[:size], self.cidr_max_extra)[0]).encode()
+        if fmt == "bin":
+            return encode_binary(ints[:size], {"model": name, "date": self.date, "size": size, "sort_key": sort_key})
+        raise ValueError(f"unknown format {fmt}, expected one of {', '.join(CONTENT_TYPES)}")
+
+    def render_gzip(self, slug: str, size: int, fmt: str) -> bytes:
+        return gzip.compress(self.render(slug, size, fmt), compresslevel=GZIP_LEVEL)
+
+    def feeds(self) -> dict:
+        return {"date": self.date, "feeds": {slug: {"model": name, "max_size": len(ips)} for slug, (name, _, ips, _) in self.rankings.items()}}
+
+
+class BlocklistRequestHandler(BaseHTTPRequestHandler):
+    store: RankingStore = None
+
+    def accepts_gzip(self) -> bool:
+        return "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def respond(self, status: int, body: bytes = b"", content_type: str = "application/json", headers: dict = None):
+        """Send a response, gzip compressing the body unless it is compressed already (Content-Encoding in headers)."""
+        headers = dict(headers or {})
+        if status != 304 and "Content-Encoding" not in headers and self.accepts_gzip():
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if status != 304:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def error(self, status: int, message: str):
+        self.respond(status, json.dumps({"error": message}).encode())
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/feeds":
+            self.respond(200, json.dumps(self.store.feeds()).encode())
+            return
+        slug = url.path.removeprefix("/feeds/")
+        if not url.path.startswith("/feeds/") or slug not in self.store.rankings:
+            self.error(404, f"unknown feed {url.path}")
+            return
+        query = parse_qs(url.query)
+        fmt = query.get("format", ["txt"])[0]
+        try:
+            size = int(query.get("size", [DEFAULT_K])[0])
+        except ValueError as e:
+            self.error(400, str(e))
+            return
+        if fmt not in CONTENT_TYPES or size < 1:
+            self.error(400, f"format must be one of {', '.join(CONTENT_TYPES)} and size must be positive")
+            return
+        size = min(size, len(self.store.rankings[slug][2]))
+        etag = self.store.etag(slug, size, fmt)
+        headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if etag_matches(self.headers.get("If-None-Match", ""), etag):
+            self.respond(304, headers=headers)
+            return
+        if self.accepts_gzip():
+            self.respond(200, self.store.render_gzip(slug, size, fmt), CONTENT_TYPES[fmt], headers | {"Content-Encoding": "gzip"})
+            return
+        self.respond(200, self.store.render(slug, size, fmt), CONTENT_TYPES[fmt], headers)
+
+
+def run():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+
+    parser.add_argument(
+        "-s",
+        "--scoring-data",
+        required=True,
+        help="Path to the .json dump whose rankings are served.",
+    )
+
+    parser.add_argument(
+        "--port",
+        help="Port to listen on (localhost only).",
+        type=int,
+        default=8766,
+    )
+
+    parser.add_argument(
+        "--cidr-max-extra",
+        help="Maximum number of non-listed addresses a single CIDR rule may cover.",
+        type=int,
+        default=0,
+    )
+
+    config = vars(parser.parse_args())
+
+    BlocklistRequestHandler.store = RankingStore(config["scoring_data"], config["cidr_max_extra"])
+    server = ThreadingHTTPServer(("127.0.0.1", config["port"]), BlocklistRequestHandler)
+    print(f"listening on http://127.0.0.1:{config['port']}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run()
@@ -34,10 +34,9 @@ Notes:
     - Only scanner-type IoCs are included in the analysis (payload requests are filtered out)
     - The module verifies that file_a's data predates file_b's data
 """
-import json
 import sys
 
-from greedybear_utils import calculate_interaction_delta, read_dump
+from greedybear_utils import calculate_interaction_delta, read_dump, write_delta_file
 
 *_, file_a, file_b, out_file_name = sys.argv
 
@@ -47,8 +46,4 @@ date_b = max(row["last_seen"] for row in b)
 assert date_a < date_b
 
 result = calculate_interaction_delta(a, date_a, b)
-
-# write result
-print(f"writing {len(result)} records to {out_file_name}")
-with open(out_file_name, "w") as file:
-    json.dump({"iocs": result, "date": date_b}, file)
+write_delta_file(result, date_b, out_file_name)
@@ -0,0 +1,79 @@
+"""
+Distillation comparison
+
+Compares every distilled student model in MODEL_DEFINITIONS with its teacher in terms
+of scoring latency and ranking quality. Both models score the same day, the resulting
+feeds are evaluated against the following day.
+
+Usage:
+    python evaluate_distillation.py -s scoring_data.json -e evaluation_data.json [--repeats 5]
+"""
+import argparse
+import time
+from statistics import median
+
+import pandas as pd
+from evaluate_time_span import K_MAX
+from models.distilled import DistilledRanker
+from models.feed import EvaluationSet, Feed
+from models.model_definitions import MODEL_DEFINITIONS
+from models.utils import build_scoring_df
+
+
+def run():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+
+    parser.add_argument(
+        "-s",
+        "--scoring-data",
+        required=True,
+        help="Path to the .json file containing the scoring data.",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--evaluation-data",
+        required=True,
+        help="Path to the .json file containing the evaluation data.",
+    )
+
+    parser.add_argument(
+        "--repeats",
+        help="Number of timed scoring runs per model.",
+        type=int,
+        default=5,
+    )
+
+    config = vars(parser.parse_args())
+
+    scoring_df, interaction_delta = build_scoring_df(config["scoring_data"], config["evaluation_data"])
+    students = [d["class"](d) for d in MODEL_DEFINITIONS if d.get("class") is DistilledRanker]
+
+    evaluation = EvaluationSet(interaction_delta)
+    out_data = []
+    for student in students:
+        for model in [student.teacher(), student]:
+            model.execute(scoring_df)  # warm up, loads the artifact
+            latencies = []
+            for _ in range(config["repeats"]):
+                start = time.perf_counter()
+                model.execute(scoring_df)
+                latencies.append(time.perf_counter() - start)
+            feed = Feed(model.name, data=scoring_df, size=K_MAX, sort_key=model.sort_key, eval_ips=evaluation)
+            feed.evaluate_range(K_MAX)
+            out_data.append(
+                {
+                    "model": model.name,
+                    "teacher": student.teacher_name,
+                    "latency_ms": median(latencies) * 1000,
+                    "us_per_ioc": median(latencies) / len(scoring_df) * 1e6,
+                    "ip_auc": feed.metrics["ip_recall_auc"],
+                    "ia_auc": feed.metrics["interaction_recall_auc"],
+                }
+            )
+
+    print(pd.DataFrame(out_data).round(4).to_string(index=False))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,67 @@
+"""
+Negative downsampling report
+
+Trains the classifiers on the same training data with different rates of
+negative downsampling and reports the training time speedup and the change in
+recall AUC on the held-out test split relative to training on all negatives.
+The results are written to ./data_out/negative_sampling_results.csv.
+
+Usage:
+    python evaluate_negative_sampling.py -d training_data.json -t training_target.json [--rates 1 0.5 0.25 0.1]
+"""
+import argparse
+import os
+
+import pandas as pd
+from models.base_model import Classifier
+from models.consts import ARTIFACT_DIR
+from models.model_definitions import MODEL_DEFINITIONS
+from train_models import build_training_df, train
+
+
+def run():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+
+    parser.add_argument(
+        "-d",
+        "--training-data",
+        required=True,
+        help="Path to the .json file containing the training data.",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--training-target",
+        required=True,
+        help="Path to the .json file containing the training targets.",
+    )
+
+    parser.add_argument(
+        "--rates",
+        help="Negative sampling rates to compare. A rate of 1 is always included as baseline.",
+        type=float,
+        nargs="+",
+        default=[0.5, 0.25, 0.1, 0.05],
+    )
+
+    config = vars(parser.parse_args())
+
+    training_df, _ = build_training_df(config["training_data"], config["training_target"])
+    out_data = []
+    for rate in sorted(set(config["rates"]) | {1.0}, reverse=True):
+        models = [d["class"](d) for d in MODEL_DEFINITIONS if d.get("trainable", False) and issubclass(d["class"], Classifier)]
+        for model in models:
+            model.artifact_dir = os.path.join(ARTIFACT_DIR, "negative_sampling", str(rate))
+        print(f"Train classifiers with negative rate {rate}.")
+        out_data.extend(r | {"rate": rate} for r in train(training_df, models=models, negative_rate=rate))
+
+    df = pd.DataFrame(out_data)
+    baseline = df[df["rate"] == 1.0].set_index("model")
+    df["speedup"] = df["model"].map(baseline["seconds"]) / df["seconds"]
+    df["recall_auc_change"] = df["recall_auc"] - df["model"].map(baseline["recall_auc"])
+    df.to_csv("./data_out/negative_sampling_results.csv", index=False)
+    print(df.pivot_table(index="model", columns="rate", values=["speedup", "recall_auc_change"]).round(4).to_string())
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,334 @@
+"""
+Sharded single-day evaluation
+
+Evaluates the feeds of all models like evaluate_single_day.py, but partitions the IOCs by
+IP prefix into independent shards. Every shard streams the dumps, keeps only its own
+records and featurizes, scores and ranks them on its own, so a worker holds roughly one
+shard's share of the data. Shards write the top rows and totals of every feed into
+--shard-dir, from which the merge step computes the exact global top-k and metrics.
+The value ranges of the features over the whole scoring dump, which some models
+normalise with, are computed once beforehand and shared through --shard-dir as well.
+The random baseline is not evaluated, as its ranking cannot be merged.
+
+Shards can run on separate machines sharing --shard-dir, between a preparation and a merge step:
+    python evaluate_sharded.py -s scoring_data.json -e evaluation_data.json --shards 4 --prepare
+    python evaluate_sharded.py -s scoring_data.json -e evaluation_data.json --shards 4 --shard 0
+    ...
+    python evaluate_sharded.py -s scoring_data.json -e evaluation_data.json --shards 4 --merge
+
+Without --shard and --merge, all shards are scored in local worker processes and merged:
+    python evaluate_sharded.py -s scoring_data.json -e evaluation_data.json --shards 4 [--workers 4]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import time
+from itertools import batched
+
+import pandas as pd
+from evaluate_single_day import apply_exclusions, calculate_scores
+from greedybear_utils import calculate_interaction_delta, iter_dump, read_delta_file
+from models.base_model import MLModel, Model
+from models.feed import EvaluationSet, Feed
+from models.model_definitions import MODEL_DEFINITIONS
+from models.parallel import evaluate_feeds
+from models.score_cache import ScoreCache, dump_hash
+from models.sharding import empty_feed_part, feature_extremes, feed_part, merge_feed_parts, shard_of
+from models.utils import MemoryPeak, get_features, join_coa_scores, load_coa_data, peak_memory_mb
+
+READ_BATCH_SIZE = 10000
+
+
+def shard_path(config: dict, index: int) -> str:
+    return os.path.join(config["shard_dir"], f"shard_{index:03d}_of_{config["shards"]:03d}.pkl")
+
+
+def largest_size(config: dict, record_count: int) -> int | None:
+    """The --test-sizes-up-to size, resolved against the number of records of the whole dump."""
+    if not config["test_sizes_up_to"]:
+        return None
+    if re.match(r"^[\d]{1,2}%$", config["test_sizes_up_to"]):
+        return record_count * int(config["test_sizes_up_to"][:-1]) // 100
+    return int(config["test_sizes_up_to"])
+
+
+def reference_path(config: dict) -> str:
+    key = dump_hash(config["scoring_data"], exclude_mass_scanners=config["exclude_mass_scanners"])
+    return os.path.join(config["shard_dir"], f"reference_{key[:16]}.pkl")
+
+
+def load_reference(config: dict) -> pd.DataFrame:
+    """
+    Value ranges of the features over the whole scoring dump (see feature_extremes).
+
+    They are computed by a single pass over the dump and stored in --shard-dir, where all
+    shards read them, so the dump is featurized once instead of once per shard.
+    """
+    path = reference_path(config)
+    if os.path.exists(path):
+        return pd.read_pickle(path, compression=None)
+    print("computing the value ranges of the features")
+    extremes = []
+    for batch in batched(iter_dump(config["scoring_data"], exclude_mass_scanners=config["exclude_mass_scanners"]), READ_BATCH_SIZE):
+        extremes.append(feature_extremes(get_features(list(batch), batch[0]["last_seen"], analyze=False)))
+    reference = pd.concat(extremes).agg(["min", "max"])
+    os.makedirs(config["shard_dir"], exist_ok=True)
+    pd.to_pickle(reference, f"{path}.tmp", compression=None)
+    os.replace(f"{path}.tmp", path)
+    return reference
+
+
+def read_shard(file_path: str, config: dict, index: int) -> tuple[list[dict], list[int], int, str]:
+    """
+    Stream a dump and keep the records of one shard.
+
+    Returns:
+        The shard's records, their positions in the dump, the number of records and the date
+        of the whole dump
+    """
+    iocs, positions = [], []
+    record_count, dump_date = 0, ""
+    for batch in batched(iter_dump(file_path, exclude_mass_scanners=config["exclude_mass_scanners"]), READ_BATCH_SIZE):
+        in_shard = shard_of([ioc["value"] for ioc in batch], config["shards"]) == index
+        iocs += [ioc for ioc, keep in zip(batch, in_shard) if keep]
+        positions += [record_count + i for i, keep in enumerate(in_shard) if keep]
+        record_count += len(batch)
+        dump_date = max(dump_date, max(ioc["last_seen"] for ioc in batch))
+    return iocs, positions, record_count, dump_date
+
+
+def write_shard(config: dict, index: int, result: dict):
+    os.makedirs(config["shard_dir"], exist_ok=True)
+    path = shard_path(config, index)
+    pd.to_pickle(result, f"{path}.tmp", compression=None)
+    os.replace(f"{path}.tmp", path)
+
+
+def score_shard(config: dict, index: int):
+    """Score and rank the IOCs of one shard and write the parts of all feeds to --shard-dir."""
+    print(f"scoring shard {index + 1} of {config["shards"]}")
+    iocs, positions, record_count, scoring_data_date = read_shard(config["scoring_data"], config, index)
+    if config["delta"]:
+        evaluation_data, evaluation_data_date = read_delta_file(config["evaluation_data"])
+        keep = shard_of(list(evaluation_data), config["shards"]) == index
+        interaction_delta = {ip: count for (ip, count), in_shard in zip(evaluation_data.items(), keep) if in_shard}
+    else:
+        evaluation_data, _, _, evaluation_data_date = read_shard(config["evaluation_data"], config, index)
+        assert scoring_data_date < evaluation_data_date
+        interaction_delta = calculate_interaction_delta(iocs, scoring_data_date, evaluation_data)
+    del evaluation_data
+
+    models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS if d["sort_key"] != "randomize"]
+    evaluation = EvaluationSet(interaction_delta)
+    result = {
+        "scoring_data_date": scoring_data_date,
+        "evaluation_data_date": evaluation_data_date,
+        "record_count": record_count,
+    }
+    if not iocs:
+        # every feed misses all evaluation IPs of a shard without scored records
+        result["feeds"] = {model.name: (model.sort_key, empty_feed_part(evaluation, model.sort_key, bool(config["coa"]))) for model in models}
+        write_shard(config, index, result)
+        print(f"shard {index + 1} of {config["shards"]}: 0 of {record_count} records")
+        return
+
+    scoring_df = get_features(iocs, scoring_data_date, analyze=False)
+    del iocs
+    scoring_df["position"] = positions
+    scoring_df["interactions_on_eval_day"] = scoring_df["value"].map(lambda ip: interaction_delta.get(ip, 0))
+    if config["coa"]:
+        join_coa_scores(scoring_df, load_coa_data(config["coa"]))
+
+    reference = load_reference(config)
+    for model in models:
+        model.fix_reference(reference)
+        if isinstance(model, MLModel):
+            model.use_artifact_before(scoring_data_date, config["model_date"])
+    cache = None
+    if not config["no_score_cache"]:
+        shard = f"{index}/{config["shards"]}"
+        cache = ScoreCache(dump_hash(config["scoring_data"], exclude_mass_scanners=config["exclude_mass_scanners"], shard=shard))
+    with MemoryPeak() as memory:
+        calculate_scores(models, scoring_df, config["inference_chunk_size"], cache=cache)
+
+    feeds = {model.name: Feed(model.name, data=scoring_df, size=config["feed_size"], sort_key=model.sort_key, eval_ips=evaluation) for model in models}
+    apply_exclusions(feeds, scoring_df, scoring_data_date)
+    k = max(config["feed_size"], largest_size(config, record_count) or 0)
+    result["feeds"] = {name: (feed.sort_key, feed_part(feed, k)) for name, feed in feeds.items()}
+    write_shard(config, index, result)
+    print(f"shard {index + 1} of {config["shards"]}: {len(scoring_df)} of {record_count} records, peak memory usage: {peak_memory_mb():.0f} MiB, of scoring: {memory.mb:.0f} MiB")
+
+
+def merge_shards(config: dict):
+    """Combine the parts written by all shards into the global feeds and evaluate them."""
+    shards = [pd.read_pickle(shard_path(config, index), compression=None) for index in range(config["shards"])]
+    if len({(shard["scoring_data_date"], shard["evaluation_data_date"], shard["record_count"]) for shard in shards}) > 1:
+        raise ValueError(f"the shards in {config["shard_dir"]} were created from different dumps")
+    scoring_data_date, evaluation_data_date = shards[0]["scoring_data_date"], shards[0]["evaluation_data_date"]
+    print(f"scoring data is from {scoring_data_date}, evaluation data is from {evaluation_data_date}")
+
+    feeds = []
+    for name, (sort_key, _) in shards[0]["feeds"].items():
+        feeds.append(merge_feed_parts(name, sort_key, [shard["feeds"][name][1] for shard in shards], config["feed_size"]))
+
+    print("evaluating")
+    max_size = largest_size(config, shards[0]["record_count"])
+    samples = max_size if max_size and config["full_resolution"] else 100
+    evaluate_feeds(feeds, max_size, samples)
+    for feed in feeds:
+        if config["details"]:
+            print(f"\n{feed.name}:")
+            print(json.dumps(feed.metrics, sort_keys=True, indent=4))
+        else:
+            print(feed)
+
+    if config["dump"]:
+        print("writing blocklists")
+        for feed in feeds:
+            feed.dump_to_txt()
+
+
+def run():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+
+    parser.add_argument(
+        "-s",
+        "--scoring-data",
+        required=True,
+        help="Path to the .json file containing the scoring data.",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--evaluation-data",
+        required=True,
+        help="Path to the .json file containing the evaluation data.",
+    )
+
+    parser.add_argument(
+        "--delta",
+        help="If evaluation data is a prepared delta file.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--shards",
+        help="Number of shards the IOCs are partitioned into.",
+        type=int,
+        required=True,
+    )
+
+    parser.add_argument(
+        "--shard",
+        help="Only score the shard with this index (starting at 0) and write its feeds to --shard-dir.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--prepare",
+        help="Only compute the value ranges of the features over the scoring data, which all shards share, and write them to --shard-dir.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--merge",
+        help="Only merge and evaluate the feeds of all shards in --shard-dir.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--shard-dir",
+        help="Directory the shards write their feeds to.",
+        default="./shards",
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="Number of shards scored in parallel when scoring all shards locally.",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--coa",
+        help="Path to the .json file containing the 'confidence of abuse' scores.",
+    )
+
+    parser.add_argument(
+        "-d",
+        "--details",
+        help="Print more metrics per feed.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--exclude-mass-scanners",
+        help="Exclude mass scanners from evaluation.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-f",
+        "--feed-size",
+        help="Number of records the generated feed should have.",
+        type=int,
+        default=5000,
+    )
+
+    parser.add_argument(
+        "--model-date",
+        help="Use the models trained on the data of this day (YYYY-MM-DD), which has to be before the scoring data. Defaults to the newest models trained before the scoring data.",
+    )
+
+    parser.add_argument(
+        "--inference-chunk-size",
+        help="Score the IOCs in blocks of this many rows to bound peak memory usage.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--no-score-cache",
+        help="Always execute the models instead of reusing cached scores of this shard.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--test-sizes-up-to",
+        help="Evaluate the feeds at sizes up to this number of records, or this percentage of all records (e.g. 10%%).",
+    )
+
+    parser.add_argument(
+        "--full-resolution",
+        help="Evaluate the feeds at every size up to --test-sizes-up-to instead of 100 evenly spaced sizes.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--dump",
+        help="Write feed data into txt file.",
+        action="store_true",
+    )
+
+    config = vars(parser.parse_args())
+
+    if config["prepare"]:
+        load_reference(config)
+        return
+    if config["shard"] is not None:
+        score_shard(config, config["shard"])
+        return
+    if not config["merge"]:
+        start = time.perf_counter()
+        load_reference(config)
+        # spawned workers start empty instead of inheriting the parent's memory, every shard gets a fresh process
+        with multiprocessing.get_context("spawn").Pool(config["workers"], maxtasksperchild=1) as pool:
+            pool.starmap(score_shard, [(config, index) for index in range(config["shards"])])
+        print(f"scoring took {time.perf_counter() - start:.1f} s")
+    merge_shards(config)
+
+
+if __name__ == "__main__":
+    run()
@@ -1,15 +1,140 @@
 import argparse
 import json
 import re
+import time
 from collections import defaultdict
-from datetime import date, timedelta
+from datetime import date
 
 import pandas as pd
 from greedybear_utils import calculate_interaction_delta, read_delta_file, read_dump
-from models.base_model import Model
-from models.feed import Feed
+from models.base_model import MLModel, Model
+from models.feed import EvaluationSet, Feed, exclusions
 from models.model_definitions import MODEL_DEFINITIONS
-from models.utils import get_features, load_coa_data, load_csv, load_txt, plot
+from models.parallel import evaluate_feeds, execute_parallel
+from models.publication import Publication
+from models.score_cache import ScoreCache, dump_hash
+from models.utils import MemoryPeak, get_features, join_coa_scores, load_coa_data, load_csv, load_txt, plot
+
+
+TABLE_METRICS = ["ip_recall", "interaction_recall", "ip_f1_score", "ip_recall_auc", "interaction_recall_auc", "avg_coa_auc"]
+
+
+def calculate_scores(models: list, scoring_df: pd.DataFrame, chunk_size: int = None, workers: int = 1, cache: ScoreCache = None) -> pd.DataFrame:
+    """
+    Add the score column of every executable model to the scoring DataFrame.
+
+    Args:
+        models: Instantiated models from MODEL_DEFINITIONS
+        scoring_df: DataFrame of features as returned by get_features
+        chunk_size: If set, machine learning models score the rows in blocks of this size
+        workers: If greater than 1, the models are executed in this many worker processes
+            on a shared-memory copy of their features
+        cache: If given, models whose scores for this data are cached are not executed,
+            the scores of all executed models are added to the cache
+
+    Returns:
+        The scoring DataFrame with one additional column per model sort key
+    """
+    executable = [model for model in models if model.estimator is not None]
+    if cache is not None:
+        executable = [model for model in executable if not cache.load(model, scoring_df)]
+    for model in executable:
+        if isinstance(model, MLModel):
+            model.inference_chunk_size = chunk_size
+    if workers > 1:
+        execute_parallel(executable, scoring_df, workers)
+    else:
+        for model in executable:
+            model.execute(scoring_df)
+    if cache is not None:
+        for model in executable:
+            cache.store(model, scoring_df)
+    return scoring_df
+
+
+def apply_exclusions(feeds: dict, scoring_df: pd.DataFrame, scoring_data_date: str):
+    """
+    Remove the IOCs GreedyBear does not list from its Recent and Persistent feeds.
+
+    Args:
+        feeds: Feeds over scoring_df by name
+        scoring_df: DataFrame of features as returned by get_features
+        scoring_data_date: Date of the scoring data
+    """
+    for name, excluded in exclusions(scoring_df, scoring_data_date).items():
+        if name in feeds:
+            feeds[name].exclude(excluded)
+
+
+def read_evaluation_data(file_path: str, delta: bool, scoring_data: list[dict], scoring_data_date: str, exclude_mass_scanners: bool = False) -> tuple[defaultdict, str]:
+    """
+    Read the interactions per IP on an evaluation day.
+
+    Args:
+        file_path: Path to a GreedyBear dump or a prepared delta file
+        delta: Whether file_path is a delta file
+        scoring_data: IOCs of the scoring data, the baseline of the interaction counts of a dump
+        scoring_data_date: Date of the scoring data
+        exclude_mass_scanners: Whether mass scanners are excluded from the dump
+
+    Returns:
+        Mapping from IP to its interactions on the evaluation day and the date of the evaluation day
+    """
+    if delta:
+        evaluation_data, evaluation_data_date = read_delta_file(file_path)
+        return defaultdict(int, evaluation_data), evaluation_data_date
+    evaluation_data = read_dump(file_path, exclude_mass_scanners=exclude_mass_scanners)
+    evaluation_data_date = max(row["last_seen"] for row in evaluation_data)
+    assert scoring_data_date < evaluation_data_date
+    return calculate_interaction_delta(scoring_data, scoring_data_date, evaluation_data), evaluation_data_date
+
+
+def create_feeds(models: list, scoring_df: pd.DataFrame, scoring_data_date: str, interaction_delta: dict, feed_size: int, external: dict = None) -> dict:
+    """
+    Create the feeds of all models and of external blocklists against the interactions of one evaluation day.
+
+    Scores are independent of the evaluation day, so the same scoring DataFrame is evaluated
+    against several days by creating the feeds once per day.
+
+    Args:
+        models: Instantiated models from MODEL_DEFINITIONS, scored into scoring_df
+        scoring_df: DataFrame of features and scores, gets the interactions of the evaluation day
+        scoring_data_date: Date of the scoring data
+        interaction_delta: Mapping from IP to its interactions on the evaluation day
+        feed_size: Number of records of every feed
+        external: External blocklists by name, as DataFrames with a "score" column
+
+    Returns:
+        The feeds by name
+    """
+    scoring_df["interactions_on_eval_day"] = scoring_df["value"].map(lambda ip: interaction_delta[ip])
+    # built after the lookups above, which add the scored IPs without interactions to the defaultdict
+    evaluation = EvaluationSet(interaction_delta)
+    feeds = {model.name: Feed(model.name, data=scoring_df, size=feed_size, sort_key=model.sort_key, eval_ips=evaluation) for model in models}
+    apply_exclusions(feeds, scoring_df, scoring_data_date)
+    for name, df in (external or {}).items():
+        df["interactions_on_eval_day"] = df["value"].map(lambda ip: interaction_delta[ip])
+        feeds[name] = Feed(name, data=df, size=feed_size, sort_key="score", eval_ips=evaluation)
+    return feeds
+
+
+def metrics_table(feeds: dict, evaluation_data_date: str, horizon: int) -> pd.DataFrame:
+    """
+    Tidy table of the evaluated feeds against one evaluation day, one row per feed.
+
+    Args:
+        feeds: Evaluated feeds by name
+        evaluation_data_date: Date of the evaluation day
+        horizon: Days between the scoring and the evaluation day
+
+    Returns:
+        DataFrame with the evaluation day, the horizon, the feed, its size and its metrics
+    """
+    rows = []
+    for feed in feeds.values():
+        metrics = [m for m in TABLE_METRICS if m in feed.metrics and (m != "avg_coa_auc" or feed.has_coa)]
+        rows.append({"evaluation_date": evaluation_data_date, "horizon_days": horizon, "feed": feed.name, "size": feed.size} | {m: feed.metrics[m] for m in metrics})
+    return pd.DataFrame(rows)
 
 
 def run():
@@ -26,12 +151,13 @@ def run():
         "-e",
         "--evaluation-data",
         required=True,
-        help="Path to the .json file containing the evaluation data.",
+        nargs="+",
+        help="Path to the .json file containing the evaluation data. Several files (e.g. of day+1, day+3 and day+7) evaluate the same scores at several horizons, whose tables are also written to ./data_out/horizons_<date>.csv.",
     )
 
     parser.add_argument(
         "--delta",
-        help="If evaluation data is a prepared delta file.",
+        help="If evaluation data are prepared delta files.",
         action="store_true",
     )
 
@@ -80,17 +206,83 @@ def run():
         default=5000,
     )
 
+    parser.add_argument(
+        "--model-date",
+        help="Use the models trained on the data of this day (YYYY-MM-DD), which has to be before the scoring data. Defaults to the newest models trained before the scoring data.",
+    )
+
+    parser.add_argument(
+        "--inference-chunk-size",
+        help="Score the IOCs in blocks of this many rows to bound peak memory usage.",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="Execute the models and evaluate the feeds in this many worker processes in parallel.",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--no-score-cache",
+        help="Always execute the models instead of reusing cached scores of this scoring data.",
+        action="store_true",
+    )
+
     parser.add_argument(
         "--test-sizes-up-to",
         help="Number of records the generated feed should have.",
     )
 
+    parser.add_argument(
+        "--full-resolution",
+        help="Evaluate the feeds at every size up to --test-sizes-up-to instead of 100 evenly spaced sizes.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--bootstrap",
+        help="Compute 95%% bootstrap confidence intervals of the recalls, F1 score and AUCs from this many replicates.",
+        type=int,
+    )
+
     parser.add_argument(
         "--dump",
         help="Write feed data into txt file.",
         action="store_true",
     )
 
+    parser.add_argument(
+        "--binary",
+        help="With --dump, also write every feed as binary blocklist, see models/blocklist_lookup.py.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--publish",
+        help="Publish every feed as new version into this directory, as delta to the previously published day plus periodic full snapshots.",
+    )
+
+    parser.add_argument(
+        "--cidr",
+        help="Report how many CIDR rules each feed collapses into. With --dump, also write the CIDR lists, with --test-sizes-up-to, write the trade-off for every evaluated size to ./data_out.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cidr-max-extra",
+        help="Maximum number of non-listed addresses a single CIDR rule may cover.",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--cidr-budget",
+        help="Maximum number of CIDR rules per feed. Rules covering the fewest listed IPs are dropped first.",
+        type=int,
+    )
+
     parser.add_argument(
         "-p",
         "--plot",
@@ -106,15 +298,13 @@ def run():
     print(f"scoring data is from {scoring_data_date}")
 
     print("loading evaluation data")
-    if config["delta"]:
-        evaluation_data, evaluation_data_date = read_delta_file(config["evaluation_data"])
-        interaction_delta = defaultdict(int, evaluation_data)
-    else:
-        evaluation_data = read_dump(config["evaluation_data"], exclude_mass_scanners=config["exclude_mass_scanners"])
-        evaluation_data_date = max(row["last_seen"] for row in evaluation_data)
-        assert scoring_data_date < evaluation_data_date
-        interaction_delta = calculate_interaction_delta(scoring_data, scoring_data_date, evaluation_data)
-    print(f"evaluation data is from {evaluation_data_date}")
+    horizons = []
+    for file_path in config["evaluation_data"]:
+        interaction_delta, evaluation_data_date = read_evaluation_data(
+            file_path, config["delta"], scoring_data, scoring_data_date, config["exclude_mass_scanners"]
+        )
+        print(f"evaluation data is from {evaluation_data_date}")
+        horizons.append((interaction_delta, evaluation_data_date))
 
     coa_scores = None
     if config["coa"]:
@@ -123,46 +313,36 @@ def run():
 
     print("extracting features")
     scoring_df = get_features(scoring_data, scoring_data_date)
-    scoring_df["interactions_on_eval_day"] = scoring_df["value"].map(lambda ip: interaction_delta[ip])
+    if coa_scores:
+        join_coa_scores(scoring_df, coa_scores)
 
     print("calculating scores")
     models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS]
     for model in models:
-        if model.estimator is not None:
-            model.execute(scoring_df)
+        if isinstance(model, MLModel):
+            model.use_artifact_before(scoring_data_date, config["model_date"])
+    cache = None
+    if not config["no_score_cache"]:
+        cache = ScoreCache(dump_hash(config["scoring_data"], exclude_mass_scanners=config["exclude_mass_scanners"]))
+    start = time.perf_counter()
+    with MemoryPeak() as memory:
+        calculate_scores(models, scoring_df, config["inference_chunk_size"], config["workers"], cache)
+    print(f"scoring took {time.perf_counter() - start:.1f} s")
+    print(f"peak memory usage of scoring: {memory.mb:.0f} MiB")
 
-    print("creating feeds")
-    three_days_ago = (date.fromisoformat(scoring_data_date) - timedelta(days=3)).isoformat()
-    two_weeks_ago = (date.fromisoformat(scoring_data_date) - timedelta(days=14)).isoformat()
-    feeds = {
-        model.name: Feed(model.name, data=scoring_df, size=config["feed_size"], sort_key=model.sort_key, eval_ips=interaction_delta, coa_scores=coa_scores)
-        for model in models
-    }
-
-    if "Recent (GreedyBear)" in feeds:
-        feeds["Recent (GreedyBear)"].exclude(scoring_df["last_seen"] < three_days_ago)
-    if "Persistent (GreedyBear)" in feeds:
-        feeds["Persistent (GreedyBear)"].exclude((scoring_df["last_seen"] < two_weeks_ago) | (scoring_df["days_seen"].str.len() < 10))
+    external = {}
     if config["prioritize_new"]:
-        csv_df = load_csv(config["prioritize_new"])
-        csv_df["interactions_on_eval_day"] = csv_df["value"].map(lambda ip: interaction_delta[ip])
-        feeds["AIP Prioritize New"] = Feed(
-            "AIP Prioritize New", data=csv_df, size=config["feed_size"], sort_key="score", eval_ips=interaction_delta, coa_scores=coa_scores
-        )
+        external["AIP Prioritize New"] = load_csv(config["prioritize_new"])
     if config["prioritize_consistent"]:
-        csv_df = load_csv(config["prioritize_consistent"])
-        csv_df["interactions_on_eval_day"] = csv_df["value"].map(lambda ip: interaction_delta[ip])
-        feeds["AIP Prioritize Consistent"] = Feed(
-            "AIP Prioritize Consistent", data=csv_df, size=config["feed_size"], sort_key="score", eval_ips=interaction_delta, coa_scores=coa_scores
-        )
+        external["AIP Prioritize Consistent"] = load_csv(config["prioritize_consistent"])
     if config["abuseipdb"]:
-        adb_df = load_txt(config["abuseipdb"])
-        adb_df["interactions_on_eval_day"] = adb_df["value"].map(lambda ip: interaction_delta[ip])
-        feeds["AbuseIPDB Blocklist"] = Feed(
-            "AbuseIPDB Blocklist", data=adb_df, size=config["feed_size"], sort_key="score", eval_ips=interaction_delta, coa_scores=coa_scores
-        )
+        external["AbuseIPDB Blocklist"] = load_txt(config["abuseipdb"])
+    if coa_scores:
+        for df in external.values():
+            join_coa_scores(df, coa_scores)
 
     print("evaluating")
+    max_size = None
     if config["test_sizes_up_to"]:
         if re.match(r"^[\d]{1,2}%$", config["test_sizes_up_to"]):
             max_size = len(scoring_data) * int(config["test_sizes_up_to"][:-1]) // 100
@@ -170,24 +350,61 @@ def run():
         else:
             max_size = int(config["test_sizes_up_to"])
             percentage = False
-        test_results = []
-        for feed in feeds.values():
-            test_results.extend(feed.evaluate_range(max_size))
-        if config["plot"]:
+    samples = max_size if max_size and config["full_resolution"] else 100
+    tables = []
+    for interaction_delta, evaluation_data_date in horizons:
+        days = (date.fromisoformat(evaluation_data_date) - date.fromisoformat(scoring_data_date)).days
+        print(f"\nevaluation day {evaluation_data_date} (+{days} {"day" if days == 1 else "days"}):")
+        feeds = create_feeds(models, scoring_df, scoring_data_date, interaction_delta, config["feed_size"], external)
+        test_results = evaluate_feeds(list(feeds.values()), max_size, samples, config["workers"])
+        if max_size and config["plot"]:
             plot(models, pd.DataFrame(test_results), scoring_data_date, evaluation_data_date, percentage)
 
-    for feed in feeds.values():
-        feed.evaluate()
+        if config["bootstrap"]:
+            for feed in feeds.values():
+                feed.bootstrap(config["bootstrap"], max_size, samples)
+
+        table = metrics_table(feeds, evaluation_data_date, days)
+        tables.append(table)
         if config["details"]:
-            print(f"\n{feed.name}:")
-            print(json.dumps(feed.metrics, sort_keys=True, indent=4))
+            for feed in feeds.values():
+                print(f"\n{feed.name}:")
+                print(json.dumps(feed.metrics, sort_keys=True, indent=4))
         else:
-            print(feed)
+            print(table.drop(columns=["evaluation_date", "horizon_days"]).to_string(index=False, float_format="{:.4f}".format))
+            if config["bootstrap"]:
+                for feed in feeds.values():
+                    print(feed.intervals_summary())
+    if len(tables) > 1:
+        pd.concat(tables).to_csv(f"./data_out/horizons_{scoring_data_date}.csv", index=False)
+
+    # the rankings do not depend on the evaluation day, so the feeds of the last one are exported
+    if config["cidr"]:
+        print("aggregating CIDR rules")
+        for feed in feeds.values():
+            if config["dump"]:
+                stats = feed.dump_to_cidr(config["cidr_max_extra"], config["cidr_budget"])
+            else:
+                stats = feed.cidr_tradeoff([feed.size], config["cidr_max_extra"], config["cidr_budget"])[0]
+            print(f"{feed.name.ljust(32)}| size: {feed.size:>5} | rules: {stats["rules"]:>5} | coverage: {stats["coverage"]:.4f} | extra addresses: {stats["extra_addresses"]}")
+        if max_size:
+            sizes = sorted({r["absolute feed size"] for r in test_results})
+            tradeoff = [r for feed in feeds.values() for r in feed.cidr_tradeoff(sizes, config["cidr_max_extra"], config["cidr_budget"])]
+            pd.DataFrame(tradeoff).to_csv(f"./data_out/cidr_tradeoff_{scoring_data_date}.csv", index=False)
+
+    if config["publish"]:
+        print("publishing blocklists")
+        for feed in feeds.values():
+            record = Publication(config["publish"], feed.name, feed.size).publish(feed.top(feed.size)["value"].to_list(), scoring_data_date)
+            if record:
+                print(f"{feed.name.ljust(32)}| version: {record["version"]:>5} | added: {record["added"]:>5} | removed: {record["removed"]:>5}")
 
     if config["dump"]:
         print("writing blocklists")
         for feed in feeds.values():
             feed.dump_to_txt()
+            if config["binary"]:
+                feed.dump_to_binary(scoring_data_date)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,18 @@
 import datetime
 import os
 import re
-import subprocess
+from collections import defaultdict
+from functools import lru_cache
 
 import pandas as pd
+from evaluate_single_day import calculate_scores, create_feeds
+from greedybear_utils import calculate_interaction_delta, read_delta_file, read_dump, write_delta_file
+from models.base_model import MLModel, Model
+from models.model_definitions import MODEL_DEFINITIONS
+from models.parallel import evaluate_feeds
+from models.score_cache import ScoreCache, dump_hash
+from models.utils import get_features, join_coa_scores, load_coa_data, load_txt
+from train_models import label_training_data, train
 
 K_MAX = 10_000
 DATA_FOLDER = "./data_in/"
@@ -39,20 +48,87 @@ def get_date_from_filename(filename: str) -> datetime.date:
     return datetime.datetime.strptime(match, "%Y%m%d").date()
 
 
-def process_evaluation_result(res: subprocess.CompletedProcess, score_date: datetime.date, ev_type: str, excl_mass: bool) -> list[dict]:
+def is_trained(training_date: datetime.date) -> bool:
     """
-    Process and normalize model evaluation results from subprocess output.
+    Check whether all trainable models already have a stored artifact for a training data date.
 
-    This function parses the stdout from an evaluation subprocess, extracts performance
-    metrics for different models, and creates two sets of records:
-    1. Original metrics as reported in the output
-    2. Normalized metrics where each value is divided by the corresponding "Upper Bound" model value
+    Args:
+        training_date: Date of the training data
+
+    Returns:
+        True if no model has to be trained for this date
+    """
+    models = [d["class"](d) for d in MODEL_DEFINITIONS if d.get("trainable", False)]
+    for model in models:
+        model.training_date = training_date.isoformat()
+    return all(model.has_artifact() for model in models)
+
+
+def load_dump(file_name: str, exclude_mass_scanners: bool = False) -> tuple[list[dict], str]:
+    """
+    Parsed dump of DATA_FOLDER and its date.
+
+    Every dump is used for training, scoring and evaluation by consecutive windows, so the
+    parsed dumps are kept in memory and each one is only read once per run.
 
     Args:
-        res: The completed subprocess result containing stdout output
+        file_name: Name of the dump in DATA_FOLDER
+        exclude_mass_scanners: If True, IOCs with "mass scanner" reputation are excluded
+
+    Returns:
+        The IOCs of the dump and the date of the dump
+    """
+    data = parse_dump(file_name)
+    if exclude_mass_scanners:
+        data = [ioc for ioc in data if ioc["ip_reputation"] != "mass scanner"]
+    return data, max(row["last_seen"] for row in data)
+
+
+@lru_cache(maxsize=3)
+def parse_dump(file_name: str) -> list[dict]:
+    return read_dump(DATA_FOLDER + file_name)
+
+
+@lru_cache(maxsize=4)
+def load_features(file_name: str, exclude_mass_scanners: bool = False) -> pd.DataFrame:
+    """Features of a dump of DATA_FOLDER, shared by the windows scoring and training on it. Callers must not modify the frame."""
+    return get_features(*load_dump(file_name, exclude_mass_scanners))
+
+
+def create_delta_files(kl_files: list[str]):
+    """Write the interactions between consecutive dumps of the second data source into DATA_FOLDER, see create_delta_file.py."""
+    for file_a, file_b in zip(kl_files, kl_files[1:]):
+        out_file_name = DATA_FOLDER + "delta_" + file_b
+        if os.path.exists(out_file_name):
+            continue
+        (a, date_a), (b, date_b) = load_dump(file_a), load_dump(file_b)
+        assert date_a < date_b
+        write_delta_file(calculate_interaction_delta(a, date_a, b), date_b, out_file_name)
+
+
+def train_day(models: list, train_file: str, target_file: str) -> list[dict]:
+    """
+    Train all trainable models on one day of DATA_FOLDER, labelled with the interactions of the following day.
+
+    Returns:
+        The training records of the models, see train_models.train
+    """
+    training_data, training_data_date = load_dump(train_file)
+    training_target, training_target_date = load_dump(target_file)
+    assert training_data_date < training_target_date
+    training_df = label_training_data(training_data, training_data_date, training_target, load_features(train_file).copy())
+    return train(training_df, models=models)
+
+
+def evaluation_records(feeds: dict, score_date: datetime.date, ev_type: str, excl_mass: bool) -> list[dict]:
+    """
+    Metrics of evaluated feeds as records, once as reported and once normalized by the "Upper Bound" feed.
+
+    Args:
+        feeds: Feeds by name, evaluated up to K_MAX
         score_date: The date associated with the evaluation scores
         ev_type: The evaluation type identifier (e.g., 'gb', 'kl')
-        excl_mass: Flag indicating whether mass was excluded in the evaluation
+        excl_mass: Flag indicating whether mass scanners were excluded in the evaluation
 
     Returns:
         list[dict]: A list of dictionaries containing both the original and normalized
@@ -60,25 +136,21 @@ def process_evaluation_result(res: subprocess.CompletedProcess, score_date: date
                    evaluation metadata, and performance metrics.
     """
     r = []
-    for line in res.stdout.split("\n"):
-        if "recall" not in line:
-            continue
-        model = line.split("|")[0].strip()
-        ip_recall, ia_recall, f1, ip_auc, ia_auc, coa_auc = list(map(float, re.findall(r"(\d{1,2}\.\d+)", line)))
+    for name, feed in feeds.items():
         r.append(
             {
-                "model": model,
+                "model": name,
                 "date": score_date,
                 "loc": ev_type,
                 "norm": False,
                 "excl_mass": excl_mass,
                 "size": K_MAX,
-                "ip_recall": ip_recall,
-                "ia_recall": ia_recall,
-                "f1": f1,
-                "ip_auc": ip_auc,
-                "ia_auc": ia_auc,
-                "coa_auc": coa_auc,
+                "ip_recall": feed.metrics["ip_recall"],
+                "ia_recall": feed.metrics["interaction_recall"],
+                "f1": feed.metrics["ip_f1_score"],
+                "ip_auc": feed.metrics["ip_recall_auc"],
+                "ia_auc": feed.metrics["interaction_recall_auc"],
+                "coa_auc": feed.metrics["avg_coa_auc"],
             }
         )
     s = []
@@ -98,17 +170,51 @@ def process_evaluation_result(res: subprocess.CompletedProcess, score_date: date
     return r + s
 
 
+def evaluate_day(models: list, score_file: str, eval_file: str, eval_kl_file: str, adb_blocklist_file: str, adb_score_file: str) -> list[dict]:
+    """
+    Score one day of DATA_FOLDER and evaluate the feeds against the following day.
+
+    The day is scored once including and once excluding mass scanners. Both scorings are
+    evaluated against the interactions in the GreedyBear dump ('gb') and in the delta file
+    of the second data source ('kl') of the following day, like evaluate_single_day.py with
+    --test-sizes-up-to K_MAX, the AbuseIPDB blocklist and its confidence of abuse scores.
+
+    Returns:
+        The evaluation records of all four evaluations, see evaluation_records
+    """
+    score_date = get_date_from_filename(score_file)
+    coa_scores = load_coa_data(DATA_FOLDER + adb_score_file)
+    external = {"AbuseIPDB Blocklist": join_coa_scores(load_txt(DATA_FOLDER + adb_blocklist_file), coa_scores)}
+    kl_delta, _ = read_delta_file(DATA_FOLDER + eval_kl_file)
+
+    records = []
+    for excl_mass in (False, True):
+        scoring_data, scoring_data_date = load_dump(score_file, excl_mass)
+        evaluation_data, evaluation_data_date = load_dump(eval_file, excl_mass)
+        assert scoring_data_date < evaluation_data_date
+        scoring_df = join_coa_scores(load_features(score_file, excl_mass).copy(), coa_scores)
+        for model in models:
+            if isinstance(model, MLModel):
+                model.use_artifact_before(scoring_data_date)
+        calculate_scores(models, scoring_df, cache=ScoreCache(dump_hash(DATA_FOLDER + score_file, exclude_mass_scanners=excl_mass)))
+        # every evaluation gets its own interaction counts, as creating the feeds adds the scored IPs to them
+        interaction_deltas = {
+            "gb": calculate_interaction_delta(scoring_data, scoring_data_date, evaluation_data),
+            "kl": defaultdict(int, kl_delta),
+        }
+        for ev_type, interaction_delta in interaction_deltas.items():
+            feeds = create_feeds(models, scoring_df, scoring_data_date, interaction_delta, K_MAX, external)
+            evaluate_feeds(list(feeds.values()), K_MAX)
+            records.extend(evaluation_records(feeds, score_date, ev_type, excl_mass))
+    return records
+
+
 def run():
     out_data = []
+    models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS]
 
     ### BUILD EVALUATION DATA
-    kl_files = [f for f in get_files() if f.startswith("kldump")]
-    for file_a, file_b in zip(kl_files, kl_files[1:]):
-        out_file_name = DATA_FOLDER + "delta_" + file_b
-        if os.path.exists(out_file_name):
-            continue
-        result = subprocess.run(["python3", "create_delta_file.py", DATA_FOLDER + file_a, DATA_FOLDER + file_b, out_file_name], capture_output=True, text=True)
-        print(result)
+    create_delta_files([f for f in get_files() if f.startswith("kldump")])
 
     ### GET RELEVANT FILES
     main_files = [f for f in get_files() if f.startswith("gbdump")]
@@ -116,9 +222,9 @@ def run():
     adb_blocklist_files = [f for f in get_files() if f.startswith("aipdb_")]
     adb_score_files = [f for f in get_files() if f.startswith("aipdscores_")]
 
-    for train, score, eval_i, eval_kl, adbb, adbs in zip(main_files, main_files[1:], main_files[2:], kl_files, adb_blocklist_files, adb_score_files):
+    for train_file, score, eval_i, eval_kl, adbb, adbs in zip(main_files, main_files[1:], main_files[2:], kl_files, adb_blocklist_files, adb_score_files):
         assert (
-            get_date_from_filename(train) + datetime.timedelta(days=2)
+            get_date_from_filename(train_file) + datetime.timedelta(days=2)
             == get_date_from_filename(score) + datetime.timedelta(days=1)
             == get_date_from_filename(eval_i)
             == get_date_from_filename(eval_kl)
@@ -127,97 +233,15 @@ def run():
         )
 
         # TRAIN
-        print(f"Train models with data {train} and {score}.")
-        result = subprocess.run(["python3", "train_models.py", "-d", DATA_FOLDER + train, "-t", DATA_FOLDER + score], capture_output=True, text=True)
-        assert result.returncode == 0
+        if is_trained(get_date_from_filename(train_file)):
+            print(f"Reuse models trained with data {train_file}.")
+        else:
+            print(f"Train models with data {train_file} and {score}.")
+            train_day(models, train_file, score)
 
         # TEST
         print(f"Test scoring performance based on {score}.")
-
-        result = subprocess.run(
-            [
-                "python3",
-                "evaluate_single_day.py",
-                "-s",
-                DATA_FOLDER + score,
-                "-e",
-                DATA_FOLDER + eval_i,
-                "-a",
-                DATA_FOLDER + adbb,
-                "--test-sizes-up-to",
-                str(K_MAX),
-                "--coa",
-                DATA_FOLDER + adbs,
-            ],
-            capture_output=True,
-            text=True,
-        )
-        assert result.returncode == 0
-        out_data.extend(process_evaluation_result(result, get_date_from_filename(score), "gb", False))
-        result = subprocess.run(
-            [
-                "python3",
-                "evaluate_single_day.py",
-                "-s",
-                DATA_FOLDER + score,
-                "-e",
-                DATA_FOLDER + eval_kl,
-                "-a",
-                DATA_FOLDER + adbb,
-                "--delta",
-                "--test-sizes-up-to",
-                str(K_MAX),
-                "--coa",
-                DATA_FOLDER + adbs,
-            ],
-            capture_output=True,
-            text=True,
-        )
-        assert result.returncode == 0
-        out_data.extend(process_evaluation_result(result, get_date_from_filename(score), "kl", False))
-        result = subprocess.run(
-            [
-                "python3",
-                "evaluate_single_day.py",
-                "-s",
-                DATA_FOLDER + score,
-                "-e",
-                DATA_FOLDER + eval_i,
-                "-a",
-                DATA_FOLDER + adbb,
-                "--test-sizes-up-to",
-                str(K_MAX),
-                "--coa",
-                DATA_FOLDER + adbs,
-                "-m",
-            ],
-            capture_output=True,
-            text=True,
-        )
-        assert result.returncode == 0
-        out_data.extend(process_evaluation_result(result, get_date_from_filename(score), "gb", True))
-        result = subprocess.run(
-            [
-                "python3",
-                "evaluate_single_day.py",
-                "-s",
-                DATA_FOLDER + score,
-                "-e",
-                DATA_FOLDER + eval_kl,
-                "-a",
-                DATA_FOLDER + adbb,
-                "--delta",
-                "--test-sizes-up-to",
-                str(K_MAX),
-                "--coa",
-                DATA_FOLDER + adbs,
-                "-m",
-            ],
-            capture_output=True,
-            text=True,
-        )
-        assert result.returncode == 0
-        out_data.extend(process_evaluation_result(result, get_date_from_filename(score), "kl", True))
+        out_data.extend(evaluate_day(models, score, eval_i, eval_kl, adbb, adbs))
 
     pd.DataFrame(out_data).to_csv("./data_out/eval_results.csv", index=False)
 
@@ -0,0 +1,91 @@
+"""
+Warm start comparison
+
+Compares daily incremental training (continuing from the previous day's artifacts)
+with full retraining over all consecutive days of GreedyBear dumps in DATA_FOLDER.
+For every day, both variants are trained, used to score the following day and
+evaluated against the day after that. Training time and interaction recall AUC
+of both variants are written to ./data_out/warm_start_results.csv.
+Logistic regression has no incremental update and is retrained from scratch in both variants.
+
+Usage:
+    python evaluate_warm_start.py
+"""
+import os
+
+import pandas as pd
+from evaluate_time_span import DATA_FOLDER, K_MAX, get_date_from_filename, get_files
+from models.consts import ARTIFACT_DIR
+from models.feed import EvaluationSet, Feed
+from models.model_definitions import MODEL_DEFINITIONS
+from models.utils import build_scoring_df
+from train_models import build_training_df, train
+
+MODES = {
+    "full": False,
+    "warm": True,
+}
+
+
+def create_models(mode: str) -> list:
+    """
+    Instantiate all trainable models with a separate artifact directory per training mode.
+
+    Args:
+        mode: Name of the training mode, one of MODES
+
+    Returns:
+        List of trainable models
+    """
+    models = [d["class"](d) for d in MODEL_DEFINITIONS if d.get("trainable", False)]
+    for model in models:
+        model.artifact_dir = os.path.join(ARTIFACT_DIR, "warm_start_comparison", mode)
+    return models
+
+
+def interaction_recall_aucs(models: list, scoring_df: pd.DataFrame, interaction_delta: dict) -> dict[str, float]:
+    """
+    Score a day with the given models and evaluate the resulting feeds against the following day.
+
+    Args:
+        models: Trained models
+        scoring_df: DataFrame as returned by build_scoring_df
+        interaction_delta: Interactions per IP on the following day
+
+    Returns:
+        Mapping from model name to the interaction recall AUC of its feed
+    """
+    evaluation = EvaluationSet(interaction_delta)
+    result = {}
+    for model in models:
+        model.execute(scoring_df)
+        feed = Feed(model.name, data=scoring_df, size=K_MAX, sort_key=model.sort_key, eval_ips=evaluation)
+        feed.evaluate_range(K_MAX)
+        result[model.name] = feed.metrics["interaction_recall_auc"]
+    return result
+
+
+def run():
+    out_data = []
+    main_files = [f for f in get_files() if f.startswith("gbdump")]
+    models = {mode: create_models(mode) for mode in MODES}
+
+    for train_file, score_file, eval_file in zip(main_files, main_files[1:], main_files[2:]):
+        training_df, _ = build_training_df(DATA_FOLDER + train_file, DATA_FOLDER + score_file)
+        scoring_df, interaction_delta = build_scoring_df(DATA_FOLDER + score_file, DATA_FOLDER + eval_file)
+        for mode, warm_start in MODES.items():
+            print(f"Train models ({mode}) with data {train_file} and {score_file}.")
+            training_results = train(training_df, warm_start=warm_start, models=models[mode])
+            aucs = interaction_recall_aucs(models[mode], scoring_df, interaction_delta)
+            for r in training_results:
+                out_data.append(r | {"mode": mode, "date": get_date_from_filename(score_file), "ia_auc": aucs[r["model"]]})
+
+    df = pd.DataFrame(out_data)
+    df.to_csv("./data_out/warm_start_results.csv", index=False)
+    # the first day has no previous artifact, so both modes train from scratch
+    df = df[df["date"] > df["date"].min()]
+    print(df.pivot_table(index="model", columns="mode", values=["seconds", "recall_auc", "ia_auc"], aggfunc="mean").round(4))
+
+
+if __name__ == "__main__":
+    run()
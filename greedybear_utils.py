@@ -1,5 +1,10 @@
 import json
+import re
 from collections import defaultdict
+from collections.abc import Iterator
+
+IOC_LIST_START = re.compile(r'"iocs"\s*:\s*\[')
+SEPARATOR = re.compile(r"[\s,]*")
 
 
 def read_dump(file_path: str, only_scanners: bool = True, exclude_mass_scanners: bool = False) -> list[dict]:
@@ -31,6 +36,58 @@ def read_dump(file_path: str, only_scanners: bool = True, exclude_mass_scanners:
     return data
 
 
+def iter_dump(file_path: str, only_scanners: bool = True, exclude_mass_scanners: bool = False, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    Stream IOC data from a GreedyBear API dump record by record.
+
+    Yields the same records in the same order as read_dump, but parses the file in chunks,
+    so callers that only keep some of the records never hold the whole dump in memory.
+
+    Args:
+        file_path (str): Path to the JSON file containing IOC data.
+        only_scanners (bool, optional): If True, only include IOCs marked as scanners.
+        exclude_mass_scanners (bool, optional): If True, exclude IOCs with
+            "mass scanner" reputation.
+        chunk_size (int, optional): Number of characters read from the file at once.
+
+    Yields:
+        dict: The next IOC dictionary passing the filters.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, "r") as file:
+        buffer = file.read(chunk_size)
+        while not (start := IOC_LIST_START.search(buffer)):
+            more = file.read(chunk_size)
+            if not more:
+                raise ValueError(f"{file_path} contains no IOC list")
+            buffer += more
+        position = start.end()
+        while True:
+            # skip the separator before the next record, refilling the buffer as it runs empty
+            while True:
+                position = SEPARATOR.match(buffer, position).end()
+                if position < len(buffer):
+                    break
+                buffer, position = file.read(chunk_size), 0
+                if not buffer:
+                    raise ValueError(f"{file_path} ends inside the IOC list")
+            if buffer[position] == "]":
+                return
+            try:
+                ioc, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                more = file.read(chunk_size)
+                if not more:
+                    raise
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            position = end
+            if (only_scanners and not ioc["scanner"]) or (exclude_mass_scanners and ioc["ip_reputation"] == "mass scanner") or not ioc["value"]:
+                continue
+            yield ioc
+
+
 def read_delta_file(file_path: str) -> tuple[dict, str]:
     """
     Read a previously created delta file.
@@ -53,6 +110,20 @@ def read_delta_file(file_path: str) -> tuple[dict, str]:
     return data, date
 
 
+def write_delta_file(interaction_delta: dict, date: str, file_path: str):
+    """
+    Write interaction counts in the format read by read_delta_file.
+
+    Args:
+        interaction_delta (dict): Mapping from IP addresses to their number of interactions.
+        date (str): Date of the day the data was recorded.
+        file_path (str): Destination of the JSON file.
+    """
+    print(f"writing {len(interaction_delta)} records to {file_path}")
+    with open(file_path, "w") as file:
+        json.dump({"iocs": interaction_delta, "date": date}, file)
+
+
 def calculate_interaction_delta(baseline: list[dict], baseline_date: str, recent: list[dict]) -> defaultdict[str, int]:
     """
     Calculate the change in interaction counts for IOCs seen after a specified date.
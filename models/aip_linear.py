@@ -1,3 +1,5 @@
+import hashlib
+
 from models.base_model import Model
 from models.utils import min_max_normalize
 
@@ -40,6 +42,23 @@ def aip_linear_scoring(row: dict, weights: dict, aging_factor: float) -> float:
 
 
 class AIPLinear(Model):
+    def __init__(self, definition):
+        super().__init__(definition)
+        self.features = list(PC_WEIGHTS) + ["days_since_last_seen", "active_timespan"]
+        self.bounds = None
+
+    def score_columns(self) -> list[str]:
+        return ["pc_score", "pn_score"]
+
+    def cache_key(self) -> str:
+        if self.bounds is None:
+            return type(self).__name__
+        return hashlib.sha256(repr(sorted(self.bounds.items())).encode()).hexdigest()
+
+    def fix_reference(self, df):
+        # normalise with the value ranges of df, so scores of later batches are comparable to the ones of df
+        self.bounds = {col: (df[col].min(), df[col].max()) for col in PC_WEIGHTS}
+
     def prioritize_consistent(self, row: dict) -> float:
         """
         The Prioritize Consistent algorithm is designed to give higher scores to IP addresses
@@ -57,7 +76,7 @@ class AIPLinear(Model):
         return aip_linear_scoring(row, PN_WEIGHTS, aging_factor)
 
     def execute(self, df):
-        normalised_df = min_max_normalize(df, PC_WEIGHTS.keys(), LOWER_IS_BETTER)
+        normalised_df = min_max_normalize(df, PC_WEIGHTS.keys(), LOWER_IS_BETTER, self.bounds)
         normalised_df["days_since_last_seen"] = df["days_since_last_seen"]
         normalised_df["active_timespan"] = df["active_timespan"]
         df["pc_score"] = normalised_df.apply(self.prioritize_consistent, axis=1)
@@ -1,15 +1,36 @@
 import abc
+import hashlib
+import json
 import os
+import tempfile
 import time
 
 import joblib
 import numpy as np
 import pandas as pd
-from models.consts import IP_REPUTATIONS, MAX_K, MULTI_VAL_FEATURES, SAMPLE_COUNT, SEARCH_CV, SEARCH_N_ITER, SEARCH_VERBOSITY
-from models.utils import multi_label_encode, one_hot_encode
+from models.consts import (
+    ARTIFACT_DIR,
+    IP_REPUTATIONS,
+    MAX_K,
+    MULTI_VAL_FEATURES,
+    SAMPLE_COUNT,
+    SEARCH_CV,
+    SEARCH_N_ITER,
+    SEARCH_VERBOSITY,
+    VALIDATION_SIZE,
+    WARM_START_FRACTION,
+)
+from models.utils import multi_label_encode, one_hot_encode, recall_auc_score
 from sklearn.experimental import enable_halving_search_cv
 from sklearn.metrics import classification_report, confusion_matrix, mean_squared_error, r2_score
-from sklearn.model_selection import HalvingRandomSearchCV, RandomizedSearchCV
+from sklearn.model_selection import HalvingRandomSearchCV, RandomizedSearchCV, train_test_split
+
+
+def atomic_dump(obj, path: str):
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        tmp_path = f.name
+    joblib.dump(obj, tmp_path)
+    os.replace(tmp_path, path)
 
 
 class Model(object):
@@ -22,27 +43,217 @@ class Model(object):
         self.focus = definition.get("focus", "general")
         self.features = []
 
+    def score_columns(self) -> list[str]:
+        """Columns written by execute."""
+        return [self.sort_key]
+
+    def cache_key(self) -> str:
+        """Identifies everything besides the input the scores depend on, used to key cached scores."""
+        return type(self).__name__
+
+    def fix_reference(self, df: pd.DataFrame):
+        """Score later batches as if their rows were part of df. Only needed by models whose scores depend on the other rows."""
+
+    def preload(self):
+        """Load everything execute needs up front, so long-running services do not pay for it on their first request."""
+
 
 class MLModel(Model):
     __metaclass__ = abc.ABCMeta
 
+    artifact_dir = ARTIFACT_DIR
+    negative_rate = 1.0
+    warm_start_fraction = WARM_START_FRACTION
+    # share of the configured iterations boosted models train from scratch, lowered for training windows
+    scratch_fraction = 1.0
+    # False for models that cannot continue from a previous artifact and are always trained from scratch
+    incremental = True
+    scaled = False
+    inference_chunk_size = None
+    early_stopping = False
+    time_budget = None
+    params = {}
+    training_date = None
+    # False while training all but the last block of a training window, see save
+    persist = True
+    unsaved = None
+
     def file_name(self) -> str:
         return self.name.replace(" ", "_").lower()
 
-    def save(self, model, scaler=None):
+    def config_hash(self) -> str:
+        """Hash of the model's features and estimator parameters, part of the artifact's key."""
+        config = {"class": type(self).__name__, "features": self.features, "params": self.params}
+        return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+    def artifact_path(self, training_date: str, suffix: str = "") -> str:
+        return f"{self.artifact_dir}/{self.file_name()}/{training_date}_{self.config_hash()}{suffix}.joblib"
+
+    def trained_dates(self, before: str = None) -> list[str]:
+        """Training data dates of all stored artifacts of this model and configuration, oldest first.
+
+        Args:
+            before: If given, only dates before this date are returned
+        """
+        suffix = f"_{self.config_hash()}.joblib"
         try:
-            os.mkdir("./.joblib")
-        except FileExistsError:
-            pass
+            files = os.listdir(f"{self.artifact_dir}/{self.file_name()}")
+        except FileNotFoundError:
+            return []
+        return sorted(d for d in (f.removesuffix(suffix) for f in files if f.endswith(suffix)) if before is None or d < before)
+
+    def use_artifact_before(self, date: str, training_date: str = None):
+        """Select the artifact to score the data of a day with.
+
+        Args:
+            date: Date of the data to be scored
+            training_date: Use the artifact of this date instead of the newest one trained before date
+
+        Raises:
+            FileNotFoundError: If no artifact was trained before date. Falling back to a newer
+                artifact would score with a model that has seen the interactions it is evaluated on.
+            ValueError: If the given training_date is not before date, for the same reason
+        """
+        if training_date is not None and training_date >= date:
+            raise ValueError(f"the artifact of {self.name} from {training_date} was not trained on data from before {date}")
+        if training_date is None:
+            dates = self.trained_dates(before=date)
+            if not dates:
+                raise FileNotFoundError(f"no artifact for {self.name} in {self.artifact_dir} was trained on data from before {date}")
+            training_date = dates[-1]
+        self.training_date = training_date
+
+    def artifact_date(self) -> str:
+        """Date of the artifact to use: the model's training_date if set, otherwise the newest one."""
+        if self.training_date is not None:
+            return self.training_date
+        dates = self.trained_dates()
+        if not dates:
+            raise FileNotFoundError(f"no trained artifact for {self.name} in {self.artifact_dir}")
+        return dates[-1]
+
+    def cache_key(self) -> str:
+        """Content hash of the artifact files that execute would load, so retrained models invalidate cached scores."""
+        training_date = self.artifact_date()
+        digest = hashlib.sha256(type(self).__name__.encode())
+        for path in [self.artifact_path(training_date)] + ([self.artifact_path(training_date, "_scaler")] if self.scaled else []):
+            with open(path, "rb") as f:
+                digest.update(hashlib.file_digest(f, "sha256").digest())
+        return digest.hexdigest()
+
+    def has_artifact(self) -> bool:
+        if self.training_date is None:
+            return len(self.trained_dates()) > 0
+        return os.path.exists(self.artifact_path(self.training_date))
+
+    def save(self, model, scaler=None):
+        """Store the trained estimator (and scaler) under the model's training_date.
+
+        Files are written to a temporary file first and then renamed, so concurrent
+        runs never read a partially written artifact. The scaler is written first,
+        as the estimator file marks the artifact as complete. The saved artifact stays
+        loaded, so scoring right after training does not read it back from disk.
+
+        Without persist, the estimator is a partial model of a training window. It is only
+        kept in memory as unsaved, which the next block continues from, so it is never
+        picked up as the artifact of its training date.
+        """
+        if not self.persist:
+            self.unsaved = (model, scaler)
+            return
+        assert self.training_date is not None, "training_date has to be set before saving a model"
+        os.makedirs(f"{self.artifact_dir}/{self.file_name()}", exist_ok=True)
         if scaler is not None:
-            joblib.dump(scaler, f"./.joblib/{self.file_name()}_scaler.joblib")
-        joblib.dump(model, f"./.joblib/{self.file_name()}.joblib")
+            atomic_dump(scaler, self.artifact_path(self.training_date, "_scaler"))
+        path = self.artifact_path(self.training_date)
+        atomic_dump(model, path)
+        stat = os.stat(path)
+        self._loaded = ((path, stat.st_mtime_ns, stat.st_size), model, scaler)
+
+    def load(self, scaler=False, training_date: str = None):
+        """Load the stored estimator (and scaler) of this model.
+
+        Without a training_date, the artifact given by artifact_date is loaded.
+        Loaded artifacts are kept in memory and only read from disk again once another
+        artifact is selected or the file has changed, so long-running processes pick up
+        retrained models.
+        """
+        training_date = training_date or self.artifact_date()
+        path = self.artifact_path(training_date)
+        stat = os.stat(path)
+        version = (path, stat.st_mtime_ns, stat.st_size)
+        cached = getattr(self, "_loaded", None)
+        if cached is None or cached[0] != version or (scaler and cached[2] is None):
+            model = joblib.load(path)
+            scaler_model = joblib.load(self.artifact_path(training_date, "_scaler")) if scaler else None
+            self._loaded = (version, model, scaler_model)
+        _, model, scaler_model = self._loaded
+        return model, scaler_model
+
+    def preload(self):
+        self.load(scaler=self.scaled)
+
+    def load_previous(self, scaler=False):
+        """Load the newest artifact trained before the model's training_date as starting point for incremental training.
+
+        The unsaved model of the previous block of a training window takes precedence.
+        Returns (None, None) if the model was never trained before, so callers can
+        fall back to training from scratch.
+        """
+        if self.unsaved is not None:
+            return self.unsaved
+        dates = self.trained_dates(before=self.training_date)
+        if not dates:
+            print(f"no previous artifact for {self.name}, training from scratch")
+            return None, None
+        return self.load(scaler, training_date=dates[-1])
+
+    @staticmethod
+    def align_features(X: pd.DataFrame, model) -> pd.DataFrame:
+        """Reorder the columns of X to match the features a fitted model was trained on.
 
-    def load(self, scaler=False):
-        model = joblib.load(f"./.joblib/{self.file_name()}.joblib")
-        if not scaler:
-            return model, None
-        return model, joblib.load(f"./.joblib/{self.file_name()}_scaler.joblib")
+        The multi-label encoded columns depend on the values present in a day's data,
+        so a honeypot that was not seen on that day is added as all-zero column and
+        unknown honeypots are dropped.
+        """
+        names = getattr(model, "feature_names_in_", None)
+        if names is None:
+            names = getattr(model, "feature_names_", None)
+        if names is None:
+            return X
+        return X.reindex(columns=list(names), fill_value=0)
+
+    def downsample_negatives(self, X, y):
+        """Subsample the negative training examples at the model's negative_rate.
+
+        All positives are kept. Kept negatives are weighted with 1 / negative_rate,
+        so the weighted class balance matches the one of the full training data.
+
+        Args:
+            X: Training features (DataFrame or array)
+            y: Training targets, positives are all values > 0
+
+        Returns:
+            The subsampled features and targets and the sample weights
+            (None if no subsampling takes place)
+        """
+        if self.negative_rate >= 1:
+            return X, y, None
+        positive = np.asarray(y > 0)
+        keep = positive | (np.random.default_rng(42).random(len(positive)) < self.negative_rate)
+        weights = np.where(positive[keep], 1.0, 1 / self.negative_rate)
+        return X[keep], y[keep], weights
+
+    def validation_split(self, X, y, *arrays):
+        """Split off a validation set for early stopping from the training data.
+
+        Returns:
+            X_train, X_val, y_train, y_val (and a train/validation pair for every
+            further array), where all validation parts are None if early stopping is disabled
+        """
+        if not self.early_stopping:
+            return [part for a in (X, y, *arrays) for part in (a, None)]
+        return train_test_split(X, y, *arrays, test_size=VALIDATION_SIZE, random_state=42)
 
     def recall_auc(self, estimator, X, y):
         """Calculate the area under the recall curve for top-k predictions.
@@ -62,16 +273,8 @@ class MLModel(Model):
             A score between 0 and 1, where 1 means perfect ranking (all positive
             instances are ranked before negative ones).
         """
-        y = y.reset_index(drop=True)
-        y_pred = pd.Series(estimator.predict_proba(X)[:, 1]) if isinstance(self, Classifier) else pd.Series(estimator.predict(X))
-        df = pd.concat([y, y_pred], axis=1).sort_values(by=0, ascending=False)
-        positives = df["interactions_on_eval_day"].sum()
-        max_k = len(X)  # // 4
-        step_size = max(max_k // SAMPLE_COUNT, 1)
-        k_values = range(step_size, max_k + step_size, step_size)
-        recalls = [df.head(k)["interactions_on_eval_day"].sum() / positives for k in k_values]
-        area = np.trapz([0] + recalls) / SAMPLE_COUNT
-        return area
+        y_pred = estimator.predict_proba(X)[:, 1] if isinstance(self, Classifier) else estimator.predict(X)
+        return recall_auc_score(y, y_pred)
 
     def random_search(self, estimator, param_dist, X, y, **kwargs):
         random_search = HalvingRandomSearchCV(
@@ -89,6 +292,36 @@ class MLModel(Model):
         random_search.fit(X, y, **kwargs)
         print("Best parameters:", random_search.best_params_)
 
+    def encode(self, df: pd.DataFrame) -> pd.DataFrame:
+        X = df[self.features]
+        for feature in MULTI_VAL_FEATURES:
+            X = multi_label_encode(X, feature)
+        return X
+
+    @abc.abstractmethod
+    def predict_scores(self, model, X) -> np.ndarray:
+        return
+
+    def execute(self, df):
+        """Score every row of df and write the scores into the model's sort_key column.
+
+        If inference_chunk_size is set, rows are encoded and scored in blocks of that
+        size to bound the memory needed for encoding and the estimator's buffers.
+        Every block is aligned to the features the estimator was trained on, so the
+        scores are identical to scoring all rows at once.
+        """
+        model, scaler = self.load(scaler=self.scaled)
+        reference = model if scaler is None else scaler
+        chunk_size = max(self.inference_chunk_size or len(df), 1)
+        scores = np.empty(len(df))
+        for start in range(0, len(df), chunk_size):
+            X = self.align_features(self.encode(df.iloc[start : start + chunk_size]), reference)
+            if scaler is not None:
+                X = scaler.transform(X)
+            scores[start : start + chunk_size] = self.predict_scores(model, X)
+        df[self.sort_key] = scores
+        return df
+
     @abc.abstractmethod
     def score(self, estimator, X, y):
         return
@@ -100,7 +333,8 @@ class Classifier(MLModel):
         y_pred = model.predict(X_test)
         y_pred_proba = model.predict_proba(X_test)
 
-        print(f"\nRecall AUC: {self.recall_auc(model, X_test,y_test):.4f}")
+        recall_auc = self.recall_auc(model, X_test, y_test)
+        print(f"\nRecall AUC: {recall_auc:.4f}")
 
         print("\nClassification Report:")
         print(classification_report(y_test, y_pred))
@@ -119,14 +353,10 @@ class Classifier(MLModel):
 
         print("\nSample of Predictions:")
         print(test_results.head())
+        return recall_auc
 
-    def execute(self, df):
-        model, _ = self.load()
-        X = df[self.features]
-        for feature in MULTI_VAL_FEATURES:
-            X = multi_label_encode(X, feature)
-        df[self.sort_key] = model.predict_proba(X)[:, 1]
-        return df
+    def predict_scores(self, model, X) -> np.ndarray:
+        return model.predict_proba(X)[:, 1]
 
 
 class Regressor(MLModel):
@@ -134,7 +364,8 @@ class Regressor(MLModel):
         print(f"\n\n######## Training Report for {self.name} ########")
         y_pred = model.predict(X_test)
 
-        print(f"\nRecall AUC: {self.recall_auc(model, X_test,y_test):.4f}")
+        recall_auc = self.recall_auc(model, X_test, y_test)
+        print(f"\nRecall AUC: {recall_auc:.4f}")
 
         if hasattr(model, "feature_importances_"):
             feature_importance = pd.DataFrame({"feature": cols, "importance": model.feature_importances_})
@@ -144,11 +375,7 @@ class Regressor(MLModel):
         test_results = pd.DataFrame({"Actual": y_test, "Predicted": y_pred})
         print("\nSample of Predictions:")
         print(test_results.head())
+        return recall_auc
 
-    def execute(self, df):
-        model, _ = self.load()
-        X = df[self.features]
-        for feature in MULTI_VAL_FEATURES:
-            X = multi_label_encode(X, feature)
-        df[self.sort_key] = model.predict(X)
-        return df
+    def predict_scores(self, model, X) -> np.ndarray:
+        return model.predict(X)
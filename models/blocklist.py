@@ -0,0 +1,127 @@
+import json
+import os
+import socket
+
+import numpy as np
+from models.blocklist_lookup import FORMAT_VERSION, HEADER, MAGIC, data_offset
+from models.utils import ipv4_to_int
+
+
+def int_to_ipv4(value: int) -> str:
+    return socket.inet_ntoa(int(value).to_bytes(4, "big"))
+
+
+def aggregate_cidrs(ips: np.ndarray, max_extra: int = 0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collapse IPv4 addresses into the minimal set of CIDR prefixes covering all of them.
+
+    A prefix may cover at most max_extra addresses that are not listed. As this only gets
+    easier for longer prefixes, taking the shortest admissible prefix of every address is
+    optimal. Prefixes are chosen from short to long, addresses covered by a chosen prefix
+    are removed before the next length is considered. Every chosen prefix is then narrowed
+    to the longest prefix that still contains all of its listed addresses, so the number of
+    non-listed addresses covered is as small as possible for the minimal number of rules.
+
+    Args:
+        ips: IPv4 addresses as integers
+        max_extra: Maximum number of non-listed addresses a single prefix may cover
+
+    Returns:
+        Network addresses, prefix lengths and number of listed addresses of the chosen prefixes
+    """
+    remaining = np.unique(ips).astype(np.int64)
+    networks, lengths, counts = [], [], []
+    for length in range(33):
+        if len(remaining) == 0:
+            break
+        host_bits = 32 - length
+        if (1 << host_bits) - len(remaining) > max_extra:
+            continue
+        _, first, inverse, prefix_counts = np.unique(remaining >> host_bits, return_index=True, return_inverse=True, return_counts=True)
+        admissible = (1 << host_bits) - prefix_counts <= max_extra
+        lowest, highest = remaining[first[admissible]], remaining[first[admissible] + prefix_counts[admissible] - 1]
+        # the bit length of lowest ^ highest is the number of host bits the narrowed prefix needs
+        narrowed_host_bits = np.frexp(lowest ^ highest)[1].astype(np.int64)
+        networks.append(lowest >> narrowed_host_bits << narrowed_host_bits)
+        lengths.append(32 - narrowed_host_bits)
+        counts.append(prefix_counts[admissible])
+        remaining = remaining[~admissible[inverse]]
+    if not networks:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(networks), np.concatenate(lengths), np.concatenate(counts)
+
+
+def select_cidrs(values, max_extra: int = 0, budget: int = None) -> tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Choose the CIDR prefixes of a list of IPs, optionally limited to a rule budget.
+
+    If the minimal set of prefixes exceeds the budget, the prefixes covering the most listed
+    addresses are kept, the others are dropped and lower the coverage.
+    Values that are not IPv4 addresses are skipped.
+
+    Args:
+        values: IP address strings or integers
+        max_extra: Maximum number of non-listed addresses a single prefix may cover
+        budget: Maximum number of rules, unlimited if None
+
+    Returns:
+        Network addresses and prefix lengths of the rules, sorted by network address, and
+        statistics on the trade-off: the number of rules, listed addresses, covered listed
+        addresses, coverage and covered non-listed addresses
+    """
+    ips = ipv4_to_int(values)
+    ips = np.unique(ips[ips >= 0])
+    networks, lengths, counts = aggregate_cidrs(ips, max_extra)
+    if budget is not None and len(networks) > budget:
+        keep = np.sort(np.argsort(-counts, kind="stable")[:budget])
+        networks, lengths, counts = networks[keep], lengths[keep], counts[keep]
+    order = np.argsort(networks)
+    covered = int(counts.sum())
+    stats = {
+        "rules": len(networks),
+        "listed": len(ips),
+        "covered": covered,
+        "coverage": covered / len(ips) if len(ips) else 1.0,
+        "extra_addresses": int((np.left_shift(1, 32 - lengths, dtype=np.int64) - counts).sum()),
+    }
+    return networks[order], lengths[order], stats
+
+
+def cidr_blocks(values, max_extra: int = 0, budget: int = None) -> tuple[list[str], dict]:
+    """
+    Turn a list of IPs into CIDR rules, see select_cidrs.
+
+    Returns:
+        The CIDR rules, sorted by network address, and the statistics of select_cidrs
+    """
+    networks, lengths, stats = select_cidrs(values, max_extra, budget)
+    return [f"{int_to_ipv4(network)}/{length}" for network, length in zip(networks, lengths)], stats
+
+
+def encode_binary(values, metadata: dict) -> bytes:
+    """
+    Encode a ranked list of IPs as binary blocklist, see models.blocklist_lookup for the format.
+
+    Values that are not IPv4 addresses are skipped, duplicates keep their best rank.
+
+    Args:
+        values: IP address strings or integers in feed order
+        metadata: JSON serializable information on the feed, stored in the header
+
+    Returns:
+        The content of the binary blocklist
+    """
+    ips = ipv4_to_int(values)
+    ranks = np.flatnonzero(ips >= 0) + 1
+    ips, first = np.unique(ips[ips >= 0], return_index=True)
+    encoded = json.dumps(metadata).encode()
+    padding = data_offset(len(encoded)) - HEADER.size - len(encoded)
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(ips), len(encoded))
+    return header + encoded + b"\0" * padding + ips.astype("<u4").tobytes() + ranks[first].astype("<u4").tobytes()
+
+
+def write_binary(path: str, values, metadata: dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(encode_binary(values, metadata))
+    os.replace(tmp_path, path)
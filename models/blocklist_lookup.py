@@ -0,0 +1,91 @@
+"""
+Membership and rank lookups in binary blocklists written by Feed.dump_to_binary.
+
+The file starts with a fixed header (magic, format version, entry count and the length of
+a JSON metadata block), followed by the metadata, the listed IPv4 addresses as a sorted
+little-endian uint32 array and the feed rank of every address as a uint32 array in the
+same order. Files are memory-mapped, so opening them is free and lookups only touch the
+pages binary search visits.
+
+Usage:
+    blocklist = BinaryBlocklist("lists/catboost_ranker_5000.bin")
+    blocklist.contains(["1.2.3.4", "5.6.7.8"])
+"""
+import json
+import struct
+
+import numpy as np
+from models.utils import ipv4_to_int
+
+MAGIC = b"GBBL"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHII")  # magic, version, reserved, entry count, metadata length
+
+
+def data_offset(metadata_length: int) -> int:
+    # the arrays start at the next multiple of 4 bytes after the metadata
+    return -(-(HEADER.size + metadata_length) // 4) * 4
+
+
+class BinaryBlocklist:
+    """
+    A memory-mapped binary blocklist.
+
+    Attributes:
+        metadata (dict): Model, date, size and score thresholds of the feed
+        ips (np.ndarray): Listed addresses as sorted uint32 array
+        ranks (np.ndarray): Rank of every listed address in the feed, starting at 1
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            magic, version, _, count, metadata_length = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(f"{path} is not a binary blocklist of format version {FORMAT_VERSION}")
+            self.metadata = json.loads(f.read(metadata_length))
+        offset = data_offset(metadata_length)
+        self.ips = np.asarray(np.memmap(path, dtype="<u4", mode="r", offset=offset, shape=(count,)))
+        self.ranks = np.asarray(np.memmap(path, dtype="<u4", mode="r", offset=offset + 4 * count, shape=(count,)))
+
+    def __len__(self):
+        return len(self.ips)
+
+    def positions(self, ips) -> tuple[np.ndarray, np.ndarray]:
+        queries = ipv4_to_int(ips)
+        valid = (queries >= 0) & (queries < 1 << 32)
+        if len(self.ips) == 0:
+            return np.zeros(len(queries), dtype=np.int64), np.zeros(len(queries), dtype=bool)
+        # searching with the dtype of the file avoids converting the mapped array,
+        # searching sorted queries lets every search start where the previous one ended
+        queries = np.where(valid, queries, 0).astype("<u4")
+        order = np.argsort(queries)
+        positions = np.empty(len(queries), dtype=np.int64)
+        positions[order] = np.minimum(np.searchsorted(self.ips, queries[order]), len(self.ips) - 1)
+        return positions, valid & (self.ips[positions] == queries)
+
+    def contains(self, ips) -> np.ndarray:
+        """
+        Check which of the given IPs are listed.
+
+        Args:
+            ips: IPv4 addresses, either as strings or as integers, which need no parsing
+
+        Returns:
+            Boolean array, True for listed addresses
+        """
+        return self.positions(ips)[1]
+
+    def rank(self, ips) -> np.ndarray:
+        """
+        Look up the feed ranks of the given IPs.
+
+        Args:
+            ips: IPv4 addresses, either as strings or as integers, which need no parsing
+
+        Returns:
+            Array of ranks starting at 1, 0 for addresses that are not listed
+        """
+        positions, found = self.positions(ips)
+        if len(self.ranks) == 0:
+            return np.zeros(len(positions), dtype=np.int64)
+        return np.where(found, self.ranks[positions], 0)
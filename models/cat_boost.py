@@ -1,9 +1,11 @@
+import time
+
 import numpy as np
 import pandas as pd
-from catboost import CatBoostClassifier, CatBoostRanker, CatBoostRegressor
-from models.base_model import Classifier, Regressor
-from models.consts import CATEGORICAL_FEATURES, ML_FEATURES, MULTI_VAL_FEATURES
-from models.utils import multi_label_encode
+from catboost import CatBoostClassifier, CatBoostRanker, CatBoostRegressor, Pool
+from models.base_model import Classifier, MLModel, Regressor
+from models.consts import CATEGORICAL_FEATURES, EARLY_STOPPING_ROUNDS, ML_FEATURES, MULTI_VAL_FEATURES, WARM_START_MAX_TREE_FACTOR
+from models.utils import multi_label_encode, recall_auc_score
 from scipy.stats import randint, uniform
 from sklearn.model_selection import train_test_split
 
@@ -18,8 +20,92 @@ COMMON_SEARCH_PARAMS = {
     "min_child_samples": randint(1, 20),
 }
 
+DEFAULT_ITERATIONS = 1000
+
+
+def continued_params(params: dict, init_model, fraction: float, scratch_fraction: float = 1.0) -> tuple[dict, object]:
+    """
+    Adjust training parameters when boosting continues from a previously trained model.
+
+    Only a fraction of the configured iterations is added on top of the previous
+    model's trees, so a daily update costs a fraction of a full retraining. Every update
+    grows the ensemble, so once it would exceed WARM_START_MAX_TREE_FACTOR times the
+    configured iterations, the model is retrained from scratch instead.
+
+    Args:
+        params: Parameters used for training from scratch
+        init_model: The previously trained model or None
+        fraction: Share of the configured iterations to add
+        scratch_fraction: Share of the configured iterations to train from scratch
+
+    Returns:
+        The parameters to pass to the CatBoost estimator and the model to continue
+        from, None if the model is trained from scratch
+    """
+    iterations = params.get("iterations", DEFAULT_ITERATIONS)
+    added = max(round(iterations * fraction), 1)
+    if init_model is not None and init_model.tree_count_ + added > iterations * WARM_START_MAX_TREE_FACTOR:
+        print(f"previous model has {init_model.tree_count_} trees, training from scratch")
+        init_model = None
+    if init_model is not None:
+        return params | {"iterations": added}, init_model
+    if scratch_fraction < 1:
+        return params | {"iterations": max(round(iterations * scratch_fraction), 1)}, None
+    return params, None
+
+
+class RecallAUCMetric:
+    """CatBoost evaluation metric scoring the validation set like MLModel.recall_auc."""
+
+    def is_max_optimal(self):
+        return True
+
+    def evaluate(self, approxes, target, weight):
+        return recall_auc_score(target, approxes[0]), 1
+
+    def get_final_error(self, error, weight):
+        return error
+
+
+class TimeBudget:
+    """CatBoost callback that stops training once a wall-clock budget (in seconds) is used up."""
+
+    def __init__(self, seconds: float):
+        self.deadline = time.monotonic() + seconds
+
+    def after_iteration(self, info):
+        return time.monotonic() < self.deadline
+
+
+def stopping_params(model: MLModel, X_val, y_val, ranking: bool = False) -> tuple[dict, dict]:
+    """
+    Build the CatBoost parameters for early stopping and the time budget of a model.
+
+    Args:
+        model: The model being trained
+        X_val: Validation features or None if early stopping is disabled
+        y_val: Validation targets
+        ranking: If True, the validation set is passed as a single query like the training data
+
+    Returns:
+        Parameters for the estimator and parameters for its fit method
+    """
+    params, fit_params = {}, {}
+    if X_val is not None:
+        params["eval_metric"] = RecallAUCMetric()
+        group_id = [1] * len(X_val) if ranking else None
+        fit_params["eval_set"] = Pool(X_val, y_val, cat_features=CATEGORICAL_FEATURES, group_id=group_id)
+        fit_params["early_stopping_rounds"] = EARLY_STOPPING_ROUNDS
+        fit_params["use_best_model"] = True
+    if model.time_budget is not None:
+        fit_params["callbacks"] = [TimeBudget(model.time_budget)]
+    return params, fit_params
+
 
 class CBClassifier(Classifier):
+    # trained with CatBoost's defaults, see hyper_param_search for the tuned parameters
+    params = {}
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + CATEGORICAL_FEATURES
@@ -37,7 +123,7 @@ class CBClassifier(Classifier):
         model = CatBoostClassifier(cat_features=CATEGORICAL_FEATURES, random_seed=42, silent=True)
         self.random_search(model, param_dist, X, y)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         y = df["interactions_on_eval_day"] > 0
 
@@ -48,31 +134,41 @@ class CBClassifier(Classifier):
             self.hyper_param_search(X, y)
             return
 
+        init_model, _ = self.load_previous() if warm_start else (None, None)
+        params, init_model = continued_params(self.params, init_model, self.warm_start_fraction, self.scratch_fraction)
+        if init_model is not None:
+            X = self.align_features(X, init_model)
+
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+        X_train, X_val, y_train, y_val = self.validation_split(X_train, y_train)
+        stopping, fit_params = stopping_params(self, X_val, y_val)
 
-        params = {
-            "bagging_temperature": 0.05819359550844361,
-            "boosting_type": "Ordered",
-            "border_count": 1,
-            "class_weights": {False: 1, True: 2},
-            "depth": 9,
-            "iterations": 217,
-            "l2_leaf_reg": 8.145959227000624,
-            "learning_rate": 0.20805921301531938,
-            "min_child_samples": 1,
-            "rsm": 0.9548652806631941,
-        }
         model = CatBoostClassifier(
             random_seed=42,
             verbose=False,
-            # **params,
+            **params,
+            **stopping,
         )
-        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES)
-        self.report(model, X_test, y_test, X.columns)
+        X_train, y_train, sample_weight = self.downsample_negatives(X_train, y_train)
+        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES, sample_weight=sample_weight, init_model=init_model, **fit_params)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
         self.save(model)
+        return recall_auc
 
 
 class CBRegressor(Regressor):
+    params = {
+        "boosting_type": "Plain",
+        "border_count": 109,
+        "depth": 9,
+        "iterations": 840,
+        "l2_leaf_reg": 10.336918237598745,
+        "learning_rate": 0.012260308940222422,
+        "loss_function": "RMSE",
+        "min_child_samples": 6,
+        "rsm": 0.36535681967405764,
+    }
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + CATEGORICAL_FEATURES
@@ -89,7 +185,7 @@ class CBRegressor(Regressor):
         model = CatBoostRegressor(cat_features=CATEGORICAL_FEATURES, random_seed=42, silent=True)
         self.random_search(model, param_dist, X, y)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         y = df["interactions_on_eval_day"]
 
@@ -100,31 +196,41 @@ class CBRegressor(Regressor):
             self.hyper_param_search(X, y)
             return
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        init_model, _ = self.load_previous() if warm_start else (None, None)
+        params, init_model = continued_params(self.params, init_model, self.warm_start_fraction, self.scratch_fraction)
+        if init_model is not None:
+            X = self.align_features(X, init_model)
 
-        params = {
-            "boosting_type": "Plain",
-            "border_count": 109,
-            "depth": 9,
-            "iterations": 840,
-            "l2_leaf_reg": 10.336918237598745,
-            "learning_rate": 0.012260308940222422,
-            "loss_function": "RMSE",
-            "min_child_samples": 6,
-            "rsm": 0.36535681967405764,
-        }
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        X_train, X_val, y_train, y_val = self.validation_split(X_train, y_train)
+        stopping, fit_params = stopping_params(self, X_val, y_val)
 
         model = CatBoostRegressor(
             random_seed=42,
             verbose=False,
             **params,
+            **stopping,
         )
-        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES)
-        self.report(model, X_test, y_test, X.columns)
+        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES, init_model=init_model, **fit_params)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
         self.save(model)
+        return recall_auc
 
 
 class CBRanker(Regressor):
+    params = {
+        "boosting_type": "Plain",
+        "border_count": 207,
+        "depth": 5,
+        "iterations": 1677,
+        "l2_leaf_reg": 5.393365018657701,
+        "leaf_estimation_method": "Newton",
+        "learning_rate": 0.019428755706020276,
+        "loss_function": "QuerySoftMax",
+        "min_child_samples": 17,
+        "rsm": 0.3143559810763267,
+    }
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + CATEGORICAL_FEATURES
@@ -143,7 +249,7 @@ class CBRanker(Regressor):
         model = CatBoostRanker(cat_features=CATEGORICAL_FEATURES, random_seed=42, silent=True)
         self.random_search(model, param_dist, X, y, group_id=query_id)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         # y = np.ceil(np.log10(df["interactions_on_eval_day"] + 1))
         y = df["interactions_on_eval_day"]
@@ -167,28 +273,25 @@ class CBRanker(Regressor):
             self.hyper_param_search(X, y, query_id)
             return
 
-        X_train, X_test, y_train, y_test, query_test, _ = train_test_split(X, y, query_id, test_size=0.2, random_state=42)
+        init_model, _ = self.load_previous() if warm_start else (None, None)
+        params, init_model = continued_params(self.params, init_model, self.warm_start_fraction, self.scratch_fraction)
+        if init_model is not None:
+            X = self.align_features(X, init_model)
 
-        params = {
-            "boosting_type": "Plain",
-            "border_count": 207,
-            "depth": 5,
-            "iterations": 1677,
-            "l2_leaf_reg": 5.393365018657701,
-            "leaf_estimation_method": "Newton",
-            "learning_rate": 0.019428755706020276,
-            "loss_function": "QuerySoftMax",
-            "min_child_samples": 17,
-            "rsm": 0.3143559810763267,
-        }
+        X_train, X_test, y_train, y_test, query_test, _ = train_test_split(X, y, query_id, test_size=0.2, random_state=42)
+        X_train, X_val, y_train, y_val = self.validation_split(X_train, y_train)
+        query_test = pd.DataFrame([1] * X_train.shape[0])
+        stopping, fit_params = stopping_params(self, X_val, y_val, ranking=True)
 
         model = CatBoostRanker(
             random_seed=42,
             verbose=False,
             # loss_function="RMSE",
             **params,
+            **stopping,
         )
 
-        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES, group_id=query_test)
-        self.report(model, X_test, y_test, X.columns)
+        model.fit(X_train, y_train, cat_features=CATEGORICAL_FEATURES, group_id=query_test, init_model=init_model, **fit_params)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
         self.save(model)
+        return recall_auc
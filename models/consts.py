@@ -39,3 +39,31 @@ IP_REPUTATIONS = [
 
 MAX_K = 10_000
 SAMPLE_COUNT = 100
+
+ARTIFACT_DIR = "./.joblib"
+
+# Share of boosting iterations (CatBoost) or trees (forests) that are
+# (re)grown on the new day's data when training incrementally.
+WARM_START_FRACTION = 0.2
+# Boosted models are retrained from scratch once incremental training would grow
+# them beyond this multiple of their configured iterations.
+WARM_START_MAX_TREE_FACTOR = 2
+
+# Early stopping on the top-k recall AUC of a held-out validation set
+VALIDATION_SIZE = 0.1
+EARLY_STOPPING_ROUNDS = 50  # boosting iterations without improvement
+FOREST_GROWTH_STEP = 10  # trees grown between two validations
+FOREST_PATIENCE = 3  # validations without improvement
+SOLVER_ITERATION_STEP = 10  # logistic regression solver iterations between two checks of the time budget
+MIN_IMPROVEMENT = 1e-4
+
+# Cached score columns of previously scored dumps
+SCORE_CACHE_DIR = "./.score_cache"
+
+# Versions between two full snapshots of a published feed
+SNAPSHOT_INTERVAL = 7
+
+# Feed size served by the scoring daemon and the blocklist server if none is requested
+DEFAULT_K = 5000
+# Sort keys of the baselines that do not score IOCs, not served as feeds
+NON_SCORING_KEYS = {"randomize", "interactions_on_eval_day"}
@@ -0,0 +1,65 @@
+from catboost import CatBoostRegressor
+from models.base_model import Regressor
+from models.cat_boost import stopping_params
+from models.consts import CATEGORICAL_FEATURES, ML_FEATURES, MULTI_VAL_FEATURES
+from sklearn.model_selection import train_test_split
+
+
+class DistilledRanker(Regressor):
+    """
+    A shallow CatBoost model trained to reproduce the scores of a heavier teacher model.
+
+    The student is fitted on the teacher's scores for the same feature frame instead of
+    the interaction counts, so it learns the teacher's ranking at a fraction of the
+    inference cost. The teacher is referenced by name via the definition's 'teacher' key
+    and has to be trained before the student.
+    """
+
+    params = {
+        "depth": 4,
+        "iterations": 100,
+        "learning_rate": 0.2,
+        "loss_function": "RMSE",
+    }
+    incremental = False
+
+    def __init__(self, definition):
+        super().__init__(definition)
+        self.features = ML_FEATURES + MULTI_VAL_FEATURES + CATEGORICAL_FEATURES
+        self.teacher_name = definition["teacher"]
+
+    def teacher(self):
+        from models.model_definitions import MODEL_DEFINITIONS
+
+        definition = next(d for d in MODEL_DEFINITIONS if d["name"] == self.teacher_name)
+        teacher = definition["class"](definition)
+        teacher.artifact_dir = self.artifact_dir
+        teacher.training_date = self.training_date
+        return teacher
+
+    def train(self, df, search=False, warm_start=False):
+        # the student is cheap to train, so it is always trained from scratch on the teacher's current scores
+        if search:
+            print(f"\nNo hyper parameter search for {self.name}")
+            return
+
+        X = self.encode(df)
+        y = df["interactions_on_eval_day"]
+        teacher = self.teacher()
+        teacher_scores = teacher.execute(df[teacher.features].copy())[teacher.sort_key]
+
+        X_train, X_test, y_train, y_test, teacher_train, _ = train_test_split(X, y, teacher_scores, test_size=0.2, random_state=42)
+        # the student is validated on the interactions rather than on the teacher's scores
+        X_train, X_val, y_train, y_val, teacher_train, _ = self.validation_split(X_train, y_train, teacher_train)
+        stopping, fit_params = stopping_params(self, X_val, y_val)
+
+        model = CatBoostRegressor(
+            random_seed=42,
+            verbose=False,
+            **self.params,
+            **stopping,
+        )
+        model.fit(X_train, teacher_train, cat_features=CATEGORICAL_FEATURES, **fit_params)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
+        self.save(model)
+        return recall_auc
@@ -1,31 +1,149 @@
-from collections import defaultdict
-from statistics import mean
+from datetime import date, timedelta
 
 import numpy as np
 import pandas as pd
+from models.blocklist import cidr_blocks, select_cidrs, write_binary
+from models.utils import ipv4_to_int
 
 DEBUG_FEATURES =["value", "last_seen", "days_seen", "active_days_ratio", "days_seen_count", "avg_days_between", "std_days_between", "days_since_last_seen", "interactions_per_day", "interactions_on_eval_day", "rfc_score",]
 METRICS = ["Interaction recall","IP recall","IP F1 score", "Average COA score"]
 
+class EvaluationSet:
+    """
+    The interactions per IP on the evaluation day, indexed once and shared by all feeds evaluated against it.
+
+    IPv4 addresses are kept as a sorted integer array next to their interaction counts, so the
+    evaluation IPs missing from a feed are found with a vectorized set difference. Other values
+    (e.g. IPv6 addresses) are rare and looked up individually. The result is cached per frame,
+    so feeds created from the same scored frame resolve it only once.
+    """
+
+    def __init__(self, eval_ips: dict):
+        ips = ipv4_to_int(eval_ips.keys())
+        interactions = np.fromiter(eval_ips.values(), dtype=np.int64, count=len(eval_ips))
+        valid = ips >= 0
+        order = np.argsort(ips[valid])
+        self.ips = ips[valid][order]
+        self.interactions = interactions[valid][order]
+        self.other = {ip: v for ip, v, is_valid in zip(eval_ips.keys(), interactions.tolist(), valid) if not is_valid}
+        self.missing_by_frame = {}
+
+    def missing(self, values) -> tuple[int, int]:
+        """
+        Count the evaluation IPs that are not among the given values, and their interactions.
+        """
+        found = np.isin(self.ips, ipv4_to_int(values))
+        ip_count, interaction_count = np.count_nonzero(~found), self.interactions[~found].sum()
+        if self.other:
+            values = set(values)
+            other_missing = [v for ip, v in self.other.items() if ip not in values]
+            ip_count, interaction_count = ip_count + len(other_missing), interaction_count + sum(other_missing)
+        return int(ip_count), int(interaction_count)
+
+    def missing_from(self, frame: pd.DataFrame) -> tuple[int, int]:
+        # the frame is kept alongside its result, so its id cannot be reused while the entry exists
+        if id(frame) not in self.missing_by_frame:
+            self.missing_by_frame[id(frame)] = (frame, self.missing(frame["value"]))
+        return self.missing_by_frame[id(frame)][1]
+
+
+def exclusions(df: pd.DataFrame, reference_day: str) -> dict[str, np.ndarray]:
+    """
+    The IOCs GreedyBear does not list in its Recent and Persistent feeds.
+
+    Every evaluated, published or served feed of these models leaves them out.
+
+    Args:
+        df: DataFrame of features as returned by get_features
+        reference_day: Date of the scored data
+
+    Returns:
+        Boolean mask aligned with df, True for excluded rows, per name of a feed with exclusions
+    """
+    three_days_ago = (date.fromisoformat(reference_day) - timedelta(days=3)).isoformat()
+    two_weeks_ago = (date.fromisoformat(reference_day) - timedelta(days=14)).isoformat()
+    return {
+        "Recent (GreedyBear)": (df["last_seen"] < three_days_ago).to_numpy(),
+        "Persistent (GreedyBear)": ((df["last_seen"] < two_weeks_ago) | (df["days_seen"].str.len() < 10)).to_numpy(),
+    }
+
+
+def top_k(keys: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k largest keys, ordered by descending key and ascending index on ties.
+
+    The k entries are found by a partial selection in O(n), only they are sorted afterwards.
+    """
+    if k >= len(keys):
+        return np.argsort(-keys, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    threshold = np.partition(keys, len(keys) - k)[len(keys) - k]
+    above = np.flatnonzero(keys > threshold)
+    selected = np.concatenate([above, np.flatnonzero(keys == threshold)[: k - len(above)]])
+    selected.sort()
+    return selected[np.argsort(-keys[selected], kind="stable")]
+
+
 class Feed:
-    def __init__(self, name: str, data: pd.DataFrame, size: int, sort_key: str, eval_ips:dict=None, coa_scores:dict=None):
+    """
+    A blocklist given by a ranking of the rows of a scored DataFrame.
+
+    Feeds only hold an index into the DataFrame they were created from, so feeds over the
+    same frame share its memory. Rows are ranked by descending sort key, ties keep the
+    order of the frame. The ranking is built lazily and only as far as it is needed:
+    a fixed-size feed selects its top rows by partial selection instead of sorting all
+    rows, counts beyond the top rows are taken from aggregates over the whole feed.
+    """
+
+    def __init__(self, name: str, data: pd.DataFrame, size: int, sort_key: str, eval_ips:dict|EvaluationSet=None):
         self.name = name
+        self.base = data
+        self.sort_key = sort_key
         if sort_key == "randomize":
-            self.data = data.sample(frac=1)
+            self.keys = None
+        elif data[sort_key].dtype == object:
+            # factorizing with sorted uniques yields integer codes in the order of the values
+            self.keys = pd.factorize(data[sort_key], sort=True)[0].astype(float)
         else:
-            self.data = data.sort_values(by=sort_key, ascending=False)
+            self.keys = np.nan_to_num(data[sort_key].to_numpy(dtype=float), nan=-np.inf)
+        self.included = np.ones(len(data), dtype=bool)
+        self.ranked = np.empty(0, dtype=np.int64)
         self.size = min(size, len(data))
         self.metrics = {}
-        self.known_ip_count = len(self.data)
+        self.known_ip_count = len(data)
         self.fn_ips_count = 0
         self.fn_ias_count = 0
         if eval_ips is not None:
-            in_feed = set(self.data["value"])
-            not_in_feed = {ip: v for ip, v in eval_ips.items() if ip not in in_feed}
-            self.fn_ips_count += len(not_in_feed)
-            self.fn_ias_count += sum(not_in_feed.values())
-        self.coa_scores = defaultdict(int, coa_scores) if coa_scores else None
+            evaluation = eval_ips if isinstance(eval_ips, EvaluationSet) else EvaluationSet(eval_ips)
+            self.fn_ips_count, self.fn_ias_count = evaluation.missing_from(data)
+        # confidence of abuse scores are evaluated if they were joined onto the frame, see join_coa_scores
+        self.has_coa = "coa_score" in data.columns
+
+    def __len__(self):
+        return np.count_nonzero(self.included)
+
+    def rank(self, k: int) -> np.ndarray:
+        """Positions in the base frame of the top k rows of the feed, in feed order."""
+        k = min(k, len(self))
+        if len(self.ranked) < k:
+            candidates = np.flatnonzero(self.included)
+            if self.keys is None:
+                self.ranked = np.random.permutation(candidates)
+            else:
+                self.ranked = candidates[top_k(self.keys[candidates], k)]
+        return self.ranked[:k]
 
+    @property
+    def order(self) -> np.ndarray:
+        return self.rank(len(self))
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return self.base.iloc[self.order]
+
+    def top(self, k: int) -> pd.DataFrame:
+        return self.base.iloc[self.rank(k)]
 
     def __repr__(self):
         res = f"{self.name.ljust(32)}| size: {self.size:>5} | recall: {self.metrics["ip_recall"]:.4f} / {self.metrics["interaction_recall"]:.4f} | F1: {self.metrics["ip_f1_score"]:.4f}"
@@ -35,72 +153,172 @@ class Feed:
         if "interaction_recall_auc" in self.metrics:
             res += f" | iaAUC: {self.metrics["interaction_recall_auc"]:.4f}"
 
-        if self.coa_scores:
+        if self.has_coa:
             res += f" | coaAUC: {self.metrics["avg_coa_auc"]:.4f}"
         return res
 
+    def intervals_summary(self) -> str:
+        """One line with the bootstrap confidence intervals in the layout of __repr__."""
+        def interval(metric):
+            low, high = self.metrics[f"{metric}_ci"]
+            return f"[{low:.4f}, {high:.4f}]"
+
+        res = f"{"".ljust(32)}| CI: {interval("ip_recall")} / {interval("interaction_recall")} | F1: {interval("ip_f1_score")}"
+        if "ip_recall_auc_ci" in self.metrics:
+            res += f" | ipAUC: {interval("ip_recall_auc")} | iaAUC: {interval("interaction_recall_auc")}"
+        return res
+
     def exclude(self, predicate):
-        excluded = self.data.loc[predicate]
-        self.known_ip_count +=len(excluded)
-        self.fn_ips_count += excluded.loc[excluded["interactions_on_eval_day"] > 0].shape[0]
-        self.fn_ias_count+=sum(excluded["interactions_on_eval_day"])
-        self.data = self.data.loc[~predicate]
+        """Remove the rows for which the boolean predicate (aligned with the base frame) holds."""
+        excluded = np.asarray(predicate, dtype=bool) & self.included
+        interactions = self.base["interactions_on_eval_day"].to_numpy()[excluded]
+        self.known_ip_count += len(interactions)
+        self.fn_ips_count += np.count_nonzero(interactions > 0)
+        self.fn_ias_count += interactions.sum()
+        self.included &= ~excluded
+        # removing rows keeps the relative order of the others, so the ranked prefix stays valid
+        self.ranked = self.ranked[self.included[self.ranked]]
 
     def set_size(self, size:int):
-        self.size = min(size, len(self.data))
+        self.size = min(size, len(self))
 
     def show_false_positives(self):
-        print(self.data.iloc[:self.size].loc[self.data["interactions_on_eval_day"] == 0].head(50)[DEBUG_FEATURES])
+        top = self.top(self.size)
+        print(top.loc[top["interactions_on_eval_day"] == 0].head(50)[DEBUG_FEATURES])
 
     def show_false_negatives(self):
-        print(self.data.iloc[self.size:].loc[self.data["interactions_on_eval_day"] >  0].head(50)[DEBUG_FEATURES])
+        rest = self.base.iloc[self.order[self.size:]]
+        print(rest.loc[rest["interactions_on_eval_day"] > 0].head(50)[DEBUG_FEATURES])
+
+    def metrics_at(self, sizes: np.ndarray) -> dict:
+        """
+        Metrics of the feed truncated to each of the given sizes, computed from one cumulative sum per count.
+        """
+        all_interactions = self.base["interactions_on_eval_day"].to_numpy()[self.included]
+        interactions = self.base["interactions_on_eval_day"].to_numpy()[self.rank(sizes.max())]
+        ip_tp = np.concatenate([[0], np.cumsum(interactions > 0)])[sizes]
+        interaction_tp = np.concatenate([[0], np.cumsum(interactions)])[sizes]
+        metrics = {}
+        metrics["ip_tp"] = ip_tp
+        metrics["ip_fp"] = sizes - ip_tp
+        metrics["ip_fn"] = np.count_nonzero(all_interactions > 0) - ip_tp + self.fn_ips_count
+        metrics["ip_precision"] = ip_tp / sizes
+        metrics["ip_recall"] = ip_tp / (ip_tp + metrics["ip_fn"])
+        metrics["ip_f1_score"] = 2*ip_tp / (2*ip_tp + metrics["ip_fp"] + metrics["ip_fn"])
+        metrics["interaction_tp"] = interaction_tp
+        metrics["interaction_fn"] = all_interactions.sum() - interaction_tp + self.fn_ias_count
+        metrics["interaction_recall"] = interaction_tp / (interaction_tp + metrics["interaction_fn"])
+        if self.has_coa:
+            coa = self.base["coa_score"].to_numpy()[self.rank(sizes.max())]
+            metrics["average_coa_score"] = np.concatenate([[0], np.cumsum(coa)])[sizes] / sizes
+        return metrics
 
     def evaluate(self):
-        self.metrics["ip_tp"]  = self.data.iloc[:self.size].loc[self.data["interactions_on_eval_day"] >  0].shape[0]
-        self.metrics["ip_fp"]  = self.data.iloc[:self.size].loc[self.data["interactions_on_eval_day"] == 0].shape[0]
-        self.metrics["ip_fn"]  = self.data.iloc[self.size:].loc[self.data["interactions_on_eval_day"] >  0].shape[0]
-        self.metrics["ip_fn"] += self.fn_ips_count
-        self.metrics["ip_precision"] = self.metrics["ip_tp"] / (
-            self.metrics["ip_tp"] + self.metrics["ip_fp"]
-        )
-        self.metrics["ip_recall"] = self.metrics["ip_tp"] / (
-            self.metrics["ip_tp"] + self.metrics["ip_fn"]
-        )
-        self.metrics["ip_f1_score"] = 2*self.metrics["ip_tp"] / (
-            2*self.metrics["ip_tp"]+ self.metrics["ip_fp"] + self.metrics["ip_fn"]
-        )
-        self.metrics["interaction_tp"]  = sum(self.data.iloc[:self.size]["interactions_on_eval_day"])
-        self.metrics["interaction_fn"]  = sum(self.data.iloc[self.size:]["interactions_on_eval_day"])
-        self.metrics["interaction_fn"] += self.fn_ias_count
-        self.metrics["interaction_recall"] = self.metrics["interaction_tp"] / (
-            self.metrics["interaction_tp"] + self.metrics["interaction_fn"]
-        )
-        if self.coa_scores:
-            self.metrics["average_coa_score"] = mean(self.coa_scores[ip] for ip in self.data.iloc[:self.size]["value"])
+        # exclusions can leave fewer rows than the size the feed was created with
+        sizes = np.array([min(self.size, len(self))])
+        self.metrics.update({key: values[0].item() for key, values in self.metrics_at(sizes).items()})
 
     def evaluate_range(self, stop: int, samples:int=100) -> list:
+        """
+        Evaluate the feed at `samples` evenly spaced sizes up to stop. With samples=stop, the curves have full resolution.
+        """
+        step = stop//samples
+        sizes = np.minimum(np.arange(step, stop + step, step), len(self))
+        curves = self.metrics_at(sizes)
+        self.size = sizes[-1].item()
+        self.evaluate()
+
         results = []
-        
-        for i in range(0,stop,stop//samples):
-            self.set_size(i+ stop//samples)
-            self.evaluate()
-            metadata = {"feed": f"{self.name}", "absolute feed size": self.size, "relative feed size": self.size/self.known_ip_count}
+        for idx, size in enumerate(sizes.tolist()):
+            metadata = {"feed": f"{self.name}", "absolute feed size": size, "relative feed size": size/self.known_ip_count}
             for metric in METRICS:
                 metric_key = metric.replace(" ", "_").lower()
-                if metric_key not in self.metrics:
+                if metric_key not in curves:
                     continue
-                data = {"value": self.metrics[metric_key], "metric": metric}
+                data = {"value": curves[metric_key][idx].item(), "metric": metric}
                 results.append(metadata | data)
-        ip_recalls =[r["value"] for r in results if r["metric"]=="IP recall"]
-        ia_recalls =[r["value"] for r in results if r["metric"]=="Interaction recall"]
-        avg_coa_scores =[r["value"] for r in results if r["metric"]=="Average COA score"]
-        self.metrics["ip_recall_auc"] = np.trapz([0] + ip_recalls) / samples
-        self.metrics["interaction_recall_auc"] = np.trapz([0] + ia_recalls) / samples
-        self.metrics["avg_coa_auc"] = np.trapz([0] + avg_coa_scores) / samples
+        self.metrics["ip_recall_auc"] = np.trapz(np.concatenate([[0], curves["ip_recall"]])) / samples
+        self.metrics["interaction_recall_auc"] = np.trapz(np.concatenate([[0], curves["interaction_recall"]])) / samples
+        self.metrics["avg_coa_auc"] = np.trapz(np.concatenate([[0], curves.get("average_coa_score", [])])) / samples
         return results
 
+    def bootstrap(self, replicates: int, stop: int = None, samples: int = 100, confidence: float = 0.95, batch_size: int = 100, seed: int = 42) -> dict:
+        """
+        Bootstrap confidence intervals of the recalls and F1 score at the feed's size and, if stop is given, of the recall AUCs.
+
+        Every replicate resamples the IOCs of the scored frame with Poisson(1) weights while their
+        ranking stays fixed. The weights of the top rows are drawn as one matrix per batch of
+        replicates, all metrics follow from weighted cumulative sums over it. The rows below the
+        top rows only enter through their totals, which are drawn per distinct interaction count,
+        as the sum of c Poisson(1) weights is Poisson(c). Evaluation IPs missing from the frame
+        are not resampled.
+
+        Returns:
+            Mapping from metric name to the lower and upper bound of its confidence interval
+        """
+        rng = np.random.default_rng(seed)
+        size = min(self.size, len(self))
+        sizes = np.minimum(np.arange(stop//samples, stop + stop//samples, stop//samples), len(self)) if stop else np.empty(0, dtype=np.int64)
+        ranked = self.rank(max(size, sizes.max(initial=0)))
+        interactions = self.base["interactions_on_eval_day"].to_numpy()
+        top = interactions[ranked].astype(float)
+        rest = np.ones(len(self.base), dtype=bool)
+        rest[ranked] = False
+        rest_values, rest_counts = np.unique(interactions[self.included & rest], return_counts=True)
+
+        def cumulative(values):
+            # prepends a zero column, so column k holds the sum over the top k rows
+            return np.pad(np.cumsum(values, axis=1), ((0, 0), (1, 0)))
+
+        draws = {metric: [] for metric in ["ip_recall", "interaction_recall", "ip_f1_score", "ip_recall_auc", "interaction_recall_auc"]}
+        for start in range(0, replicates, batch_size):
+            n = min(batch_size, replicates - start)
+            weights = rng.poisson(1.0, size=(n, len(ranked)))
+            rest_draws = rng.poisson(rest_counts, size=(n, len(rest_counts)))
+            ip_tp = cumulative(weights * (top > 0))
+            interaction_tp = cumulative(weights * top)
+            ip_total = ip_tp[:, -1] + rest_draws[:, rest_values > 0].sum(axis=1) + self.fn_ips_count
+            interaction_total = interaction_tp[:, -1] + rest_draws @ rest_values + self.fn_ias_count
+
+            tp = ip_tp[:, size]
+            fp = cumulative(weights)[:, size] - tp
+            draws["ip_recall"].append(tp / ip_total)
+            draws["interaction_recall"].append(interaction_tp[:, size] / interaction_total)
+            draws["ip_f1_score"].append(2*tp / (2*tp + fp + ip_total - tp))
+            if stop:
+                ip_curve = ip_tp[:, np.concatenate([[0], sizes])] / ip_total[:, None]
+                interaction_curve = interaction_tp[:, np.concatenate([[0], sizes])] / interaction_total[:, None]
+                draws["ip_recall_auc"].append(np.trapz(ip_curve, axis=1) / samples)
+                draws["interaction_recall_auc"].append(np.trapz(interaction_curve, axis=1) / samples)
+
+        alpha = (1 - confidence) / 2
+        intervals = {metric: np.quantile(np.concatenate(values), [alpha, 1 - alpha]).tolist() for metric, values in draws.items() if values}
+        self.metrics.update({f"{metric}_ci": interval for metric, interval in intervals.items()})
+        return intervals
+
+    def cidr_tradeoff(self, sizes: list[int], max_extra: int = 0, budget: int = None) -> list[dict]:
+        """Number of CIDR rules and coverage of the feed truncated to each of the given sizes, see select_cidrs."""
+        # converted once, select_cidrs passes the integer prefixes through
+        values = ipv4_to_int(self.top(max(sizes))["value"].to_numpy())
+        return [{"feed": self.name, "absolute feed size": size} | select_cidrs(values[:size], max_extra, budget)[2] for size in sizes]
+
+    def dump_to_cidr(self, max_extra: int = 0, budget: int = None) -> dict:
+        file_name = f"{self.name.replace(" ", "_").lower()}_{self.size}_cidr.txt"
+        rules, stats = cidr_blocks(self.top(self.size)["value"], max_extra, budget)
+        with open(f"./lists/{file_name}", "w") as f:
+            f.write("\n".join(rules))
+        return stats
+
+    def dump_to_binary(self, date: str):
+        file_name = f"{self.name.replace(" ", "_").lower()}_{self.size}.bin"
+        top = self.top(self.size)
+        metadata = {"model": self.name, "date": date, "size": self.size, "sort_key": self.sort_key}
+        if self.keys is not None and len(top) > 0:
+            metadata["max_score"], metadata["min_score"] = top[self.sort_key].iloc[[0, -1]].tolist()
+        write_binary(f"./lists/{file_name}", top["value"], metadata)
+
     def dump_to_txt(self):
         file_name = f"{self.name.replace(" ", "_").lower()}_{self.size}.txt"
-        ips = self.data.iloc[:self.size]["value"].to_list()
+        ips = self.top(self.size)["value"].to_list()
         with open(f"./lists/{file_name}", "w") as f:
             f.write("\n".join(ips))
@@ -0,0 +1,184 @@
+import heapq
+
+import numpy as np
+import pandas as pd
+from models.feed import exclusions
+from models.utils import get_features
+
+
+def ranking_values(column: pd.Series) -> np.ndarray:
+    """Scores as floats, dates (last_seen) as day numbers. Missing scores rank last, as in Feed."""
+    if column.dtype == object:
+        return pd.to_datetime(column).to_numpy().astype("datetime64[D]").astype(np.float64)
+    return np.nan_to_num(column.to_numpy(dtype=np.float64), nan=-np.inf)
+
+
+class IncrementalFeed:
+    """
+    Top-k of one model, kept up to date while the scores of single IPs change.
+
+    All IPs are split into two heaps: the k best ones in a min-heap, whose root is the
+    entry that leaves the feed next, all others in a max-heap, whose root is the entry that
+    enters next. A changed score is pushed as new entry and moves at most one entry between
+    the heaps, so an update costs O(log n). Replaced entries stay in the heaps and are
+    dropped once they reach a root, the heaps are rebuilt when replaced entries make up half
+    of them. Ties are broken by the order the IPs were first seen, like in Feed. Excluded
+    IPs are no candidates of the feed until they are updated without exclusion.
+
+    Attributes:
+        k (int): Size of the feed
+        positions (dict): First-seen position of every IP
+        scores (dict): Current score and first-seen position of every IP that is not excluded
+        members (set): IPs currently in the feed
+    """
+
+    def __init__(self, ips: np.ndarray, scores: np.ndarray, k: int, excluded: np.ndarray = None):
+        self.k = k
+        self.positions = {ip: position for position, ip in enumerate(ips)}
+        candidates = np.arange(len(ips)) if excluded is None else np.flatnonzero(~excluded)
+        self.scores = {ips[i]: (scores[i], i) for i in candidates.tolist()}
+        self.rebuild(set(ips[candidates[np.argsort(-scores[candidates], kind="stable")[:k]]]))
+
+    def __len__(self):
+        return len(self.members)
+
+    def rebuild(self, members: set):
+        self.members = members
+        self.top = [(score, -position, ip) for ip, (score, position) in self.scores.items() if ip in members]
+        self.rest = [(-score, position, ip) for ip, (score, position) in self.scores.items() if ip not in members]
+        heapq.heapify(self.top)
+        heapq.heapify(self.rest)
+        self.ranked = None
+
+    def valid_top(self, entry: tuple) -> bool:
+        return entry[2] in self.members and self.scores.get(entry[2]) == (entry[0], -entry[1])
+
+    def valid_rest(self, entry: tuple) -> bool:
+        return entry[2] not in self.members and self.scores.get(entry[2]) == (-entry[0], entry[1])
+
+    def clean(self):
+        while self.top and not self.valid_top(self.top[0]):
+            heapq.heappop(self.top)
+        while self.rest and not self.valid_rest(self.rest[0]):
+            heapq.heappop(self.rest)
+
+    def update(self, ip: str, score: float) -> tuple[str | None, str | None]:
+        """
+        Set the score of an IP, new IPs rank after all known ones with the same score.
+
+        Returns:
+            The IP that entered the feed and the IP that left it, None if there was none
+        """
+        position = self.positions.setdefault(ip, len(self.positions))
+        self.scores[ip] = (score, position)
+        if ip in self.members:
+            heapq.heappush(self.top, (score, -position, ip))
+            self.ranked = None
+        else:
+            heapq.heappush(self.rest, (-score, position, ip))
+        entered = left = None
+        self.clean()
+        if len(self.members) < self.k and self.rest:
+            entered = heapq.heappop(self.rest)[2]
+        elif self.top and self.rest and (-self.rest[0][0], -self.rest[0][1]) > self.top[0][:2]:
+            entered, left = heapq.heappop(self.rest)[2], heapq.heappop(self.top)[2]
+            self.members.discard(left)
+            heapq.heappush(self.rest, (-self.scores[left][0], self.scores[left][1], left))
+        if entered is not None:
+            self.members.add(entered)
+            heapq.heappush(self.top, (self.scores[entered][0], -self.scores[entered][1], entered))
+            self.ranked = None
+        if len(self.top) + len(self.rest) > 2 * len(self.scores):
+            self.rebuild(self.members)
+        return entered, left
+
+    def exclude(self, ip: str) -> tuple[str | None, str | None]:
+        """
+        Remove an IP from the feed and its candidates, the best remaining candidate takes its place.
+
+        Returns:
+            The IP that entered the feed and the IP that left it, None if there was none
+        """
+        self.positions.setdefault(ip, len(self.positions))
+        if self.scores.pop(ip, None) is None:
+            return None, None
+        entered = left = None
+        if ip in self.members:
+            self.members.discard(ip)
+            left = ip
+            self.ranked = None
+        self.clean()
+        if len(self.members) < self.k and self.rest:
+            entered = heapq.heappop(self.rest)[2]
+            self.members.add(entered)
+            heapq.heappush(self.top, (self.scores[entered][0], -self.scores[entered][1], entered))
+        return entered, left
+
+    def feed(self) -> list[str]:
+        """The IPs of the feed in rank order. Sorted only once after the feed changed."""
+        if self.ranked is None:
+            self.ranked = sorted(self.members, key=lambda ip: (-self.scores[ip][0], self.scores[ip][1]))
+        return self.ranked
+
+
+class IncrementalRanking:
+    """
+    Incremental feeds of several models on top of a scored dump, updated from single IOC records.
+
+    Updated IOCs are scored with the given, already loaded models against the dump's
+    reference day, IOCs seen after it count as seen on the reference day. Models whose
+    scores depend on the other rows score them as if they were part of the dump (see
+    Model.fix_reference). IOCs GreedyBear does not list are left out of its feeds, as in the
+    evaluated feeds (see models.feed.exclusions). The feeds are rebuilt from the next full dump.
+
+    Attributes:
+        models (list): Models the feeds are kept for
+        reference_day (str): Date the features of updated IOCs are calculated for
+        k (int): Size of the feeds
+        feeds (dict): IncrementalFeed per model name
+    """
+
+    def __init__(self, models: list, scored_df: pd.DataFrame, reference_day: str, k: int):
+        self.models = models
+        self.reference_day = reference_day
+        self.k = k
+        for model in models:
+            model.fix_reference(scored_df)
+        ips = scored_df["value"].to_numpy()
+        excluded = exclusions(scored_df, reference_day)
+        self.feeds = {model.name: IncrementalFeed(ips, ranking_values(scored_df[model.sort_key]), k, excluded.get(model.name)) for model in models}
+
+    def ingest(self, iocs: list[dict]) -> dict:
+        """
+        Score updated IOC records and apply their new scores to every feed.
+
+        Args:
+            iocs: IOC records in the format of the GreedyBear dump, new or updated
+
+        Returns:
+            Per model, the IPs that entered and left its feed
+        """
+        batch_df = get_features(iocs, self.reference_day, analyze=False)
+        for column in ("days_since_last_seen", "days_since_first_seen"):
+            batch_df[column] = batch_df[column].clip(lower=0)
+        for model in self.models:
+            if model.estimator is not None:
+                model.execute(batch_df)
+        excluded = exclusions(batch_df, self.reference_day)
+        changes = {}
+        for model in self.models:
+            feed, entered, left = self.feeds[model.name], set(), set()
+            is_excluded = excluded.get(model.name, np.zeros(len(batch_df), dtype=bool))
+            for ip, score, exclude in zip(batch_df["value"], ranking_values(batch_df[model.sort_key]), is_excluded):
+                new, old = feed.exclude(ip) if exclude else feed.update(ip, score)
+                # an IP that enters and leaves within the same batch did not change the feed
+                if new in left:
+                    left.discard(new)
+                elif new is not None:
+                    entered.add(new)
+                if old in entered:
+                    entered.discard(old)
+                elif old is not None:
+                    left.add(old)
+            changes[model.name] = {"entered": sorted(entered), "left": sorted(left)}
+        return changes
@@ -1,12 +1,68 @@
-from models.base_model import Classifier
-from models.consts import IP_REPUTATIONS, ML_FEATURES, MULTI_VAL_FEATURES
+import time
+import warnings
+
+import numpy as np
+from models.base_model import Classifier, MLModel
+from models.consts import IP_REPUTATIONS, ML_FEATURES, MULTI_VAL_FEATURES, SOLVER_ITERATION_STEP
 from models.utils import multi_label_encode, one_hot_encode
+from scipy.special import expit
+from sklearn.exceptions import ConvergenceWarning
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 
 
+def fit_within_budget(ml_model: MLModel, model: LogisticRegression, X_train, y_train, sample_weight=None) -> LogisticRegression:
+    """
+    Fit a logistic regression, stopping the solver once the model's time budget is used up.
+
+    The solver runs SOLVER_ITERATION_STEP iterations at a time, each step continuing from
+    the coefficients of the previous one, until it converged, max_iter iterations were run
+    or the budget is used up.
+
+    Args:
+        ml_model: The model being trained, providing the time budget
+        model: An unfitted LogisticRegression
+        X_train: Training features
+        y_train: Training targets
+        sample_weight: Optional weights of the training examples
+
+    Returns:
+        The fitted model
+    """
+    if ml_model.time_budget is None:
+        return model.fit(X_train, y_train, sample_weight=sample_weight)
+    deadline = time.monotonic() + ml_model.time_budget
+    max_iter, iterations = model.max_iter, 0
+    with warnings.catch_warnings():
+        # every step but the last one stops the solver before it converged
+        warnings.simplefilter("ignore", ConvergenceWarning)
+        while iterations < max_iter:
+            model.set_params(warm_start=True, max_iter=min(SOLVER_ITERATION_STEP, max_iter - iterations))
+            model.fit(X_train, y_train, sample_weight=sample_weight)
+            iterations += model.n_iter_[0]
+            if model.n_iter_[0] < model.max_iter:
+                break
+            if time.monotonic() > deadline:
+                print(f"time budget of {ml_model.name} used up after {iterations} solver iterations")
+                break
+    model.set_params(warm_start=False, max_iter=max_iter)
+    return model
+
+
 class LogisticRegressor(Classifier):
+    params = {
+        "tol": 0.0001,
+        "solver": "newton-cg",
+        "penalty": "l2",
+        "max_iter": 1000,
+        "class_weight": None,
+        "C": 0.1,
+    }
+
+    scaled = True
+    incremental = False
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + ["ip_reputation"]
@@ -30,7 +86,7 @@ class LogisticRegressor(Classifier):
         model = LogisticRegression()
         self.random_search(model, param_dist, X, y)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         y = df["interactions_on_eval_day"] > 0
 
@@ -39,6 +95,8 @@ class LogisticRegressor(Classifier):
         for feature in MULTI_VAL_FEATURES:
             X = multi_label_encode(X, feature)
 
+        # no incremental update: warm starting the convex solver only moves its starting point, the
+        # fit still converges to the optimum of this day's data alone, so warm_start is ignored
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
 
         scaler = StandardScaler()
@@ -49,29 +107,24 @@ class LogisticRegressor(Classifier):
             self.hyper_param_search(X_train, y_train)
             return
 
-        params = {
-            "tol": 0.0001,
-            "solver": "newton-cg",
-            "penalty": "l2",
-            "max_iter": 1000,
-            "class_weight": None,
-            "C": 0.1,
-        }
         lg_model = LogisticRegression(
             random_state=42,
-            **params,
+            **self.params,
         )
-        lg_model.fit(X_train, y_train)
-        self.report(lg_model, X_test, y_test, X.columns)
+        X_train, y_train, sample_weight = self.downsample_negatives(X_train, y_train)
+        fit_within_budget(self, lg_model, X_train, y_train, sample_weight)
+        recall_auc = self.report(lg_model, X_test, y_test, X.columns)
         self.save(lg_model, scaler)
+        return recall_auc
+
+    def predict_scores(self, model, X):
+        # Same as predict_proba, but with a row-wise dot product instead of a BLAS matrix
+        # product, so the scores do not depend on how many rows are scored at once.
+        return expit(np.einsum("ij,j->i", X, model.coef_[0]) + model.intercept_[0])
 
-    def execute(self, df):
-        lg_model, scaler = self.load(scaler=True)
+    def encode(self, df):
         X = df[self.features]
         X = one_hot_encode(X, "ip_reputation", IP_REPUTATIONS)
         for feature in MULTI_VAL_FEATURES:
             X = multi_label_encode(X, feature)
-        # print(scaler.feature_names_in_)
-        # print(X.columns)
-        df["lg_score"] = lg_model.predict_proba(scaler.transform(X))[:, 1]
-        return df
+        return X
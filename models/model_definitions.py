@@ -1,5 +1,6 @@
 from models.aip_linear import AIPLinear
 from models.cat_boost import CBClassifier, CBRanker, CBRegressor
+from models.distilled import DistilledRanker
 from models.logistic_regressor import LogisticRegressor
 from models.random_forest import RFClassifier, RFRegressor
 from models.threat_level import ThreatLevel
@@ -80,6 +81,15 @@ MODEL_DEFINITIONS = [
         "sort_key": "cbr_score",
         "focus": "interactions",
     },
+    {
+        "name": "Distilled CatBoost Ranker",
+        "class": DistilledRanker,
+        "trainable": True,
+        "colour": "steelblue",
+        "sort_key": "dcbr_score",
+        "focus": "interactions",
+        "teacher": "CatBoost Ranker",
+    },
     {
         "name": "Upper Bound",
         "colour": "black",
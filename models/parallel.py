@@ -0,0 +1,178 @@
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+from threadpoolctl import threadpool_limits
+
+
+class SharedFrame:
+    """
+    Columns of a DataFrame placed in shared memory, so worker processes can read them without pickling.
+
+    Numeric columns are copied into one shared block each. Object columns (categories and lists
+    of honeypots) are factorized: their integer codes are placed in shared memory and only
+    the unique values are passed to the workers.
+
+    Attributes:
+        handle (dict): Picklable description of the shared blocks, see attach
+    """
+
+    def __init__(self, df: pd.DataFrame, columns: list[str]):
+        self.blocks = []
+        self.handle = {"length": len(df), "columns": []}
+        for column in columns:
+            values, uniques = df[column].to_numpy(), None
+            if values.dtype == object:
+                codes, uniques = pd.factorize(df[column].map(lambda v: tuple(v) if isinstance(v, list) else v))
+                values, uniques = codes, [list(u) if isinstance(u, tuple) else u for u in uniques]
+            block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+            self.blocks.append(block)
+            self.handle["columns"].append((column, block.name, values.dtype.str, uniques))
+
+    @staticmethod
+    def attach(handle: dict) -> tuple[pd.DataFrame, list]:
+        """
+        Rebuild the DataFrame from the shared blocks of a SharedFrame in another process.
+
+        Args:
+            handle: The handle attribute of the SharedFrame
+
+        Returns:
+            The DataFrame and the attached blocks, which have to be closed once the DataFrame is no longer used
+        """
+        columns, blocks = {}, []
+        for column, name, dtype, uniques in handle["columns"]:
+            block = shared_memory.SharedMemory(name=name)
+            values = np.ndarray(handle["length"], dtype=dtype, buffer=block.buf)
+            if uniques is not None:
+                lookup = np.empty(len(uniques), dtype=object)
+                lookup[:] = uniques
+                values = lookup[values]
+            columns[column] = values
+            blocks.append(block)
+        return pd.DataFrame(columns, copy=False), blocks
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def execute_shared(model, handle: dict) -> dict[str, np.ndarray]:
+    """
+    Run a model on the shared feature frame and return the score columns it added.
+
+    Args:
+        model: Model to execute
+        handle: Handle of the SharedFrame holding the model's features
+
+    Returns:
+        Mapping from column name to scores for every column the model added
+    """
+    df, blocks = SharedFrame.attach(handle)
+    try:
+        known = set(df.columns)
+        model.execute(df)
+        return {column: df[column].to_numpy() for column in df.columns if column not in known}
+    finally:
+        del df
+        for block in blocks:
+            block.close()
+
+
+def execute_parallel(models: list, df: pd.DataFrame, workers: int) -> pd.DataFrame:
+    """
+    Execute independent models in worker processes on a shared copy of their features.
+
+    The features used by any of the models are placed in shared memory once. Every model
+    runs in its own task and its score columns are merged back into df.
+
+    Args:
+        models: Models to execute
+        df: DataFrame of features as returned by get_features
+        workers: Number of worker processes
+
+    Returns:
+        The DataFrame with the score columns of all models
+    """
+    columns = list(dict.fromkeys(feature for model in models for feature in model.features))
+    with SharedFrame(df, columns) as frame, ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(execute_shared, model, frame.handle) for model in models]
+        for future in futures:
+            for column, scores in future.result().items():
+                df[column] = scores
+    return df
+
+
+# feeds evaluated by the worker processes of evaluate_feeds, inherited when the workers are forked
+inherited_feeds = []
+
+
+def evaluate_feed(feed, max_size: int = None, samples: int = 100) -> list:
+    """
+    Evaluate a feed at its size and, if max_size is given, at sizes up to max_size.
+
+    Returns:
+        The range results of the feed, empty without max_size
+    """
+    results = feed.evaluate_range(max_size, samples) if max_size else []
+    feed.evaluate()
+    return results
+
+
+def evaluate_inherited(index: int, max_size: int, samples: int) -> tuple:
+    feed = inherited_feeds[index]
+    results = evaluate_feed(feed, max_size, samples)
+    return results, feed.metrics, feed.size, feed.ranked
+
+
+def evaluate_feeds(feeds: list, max_size: int = None, samples: int = 100, workers: int = 1) -> list:
+    """
+    Evaluate feeds, optionally in parallel worker processes.
+
+    The workers are forked, so they read the feeds and the scored frames they index
+    without copying or pickling them. Metrics, sizes and rankings are copied back onto
+    the feeds, results are gathered in the order of feeds, so the outcome equals a
+    serial evaluation.
+
+    Once models have run, the thread pools of OpenMP, BLAS and CatBoost stay alive, and
+    forking copies only the calling thread. The pools are limited to a single thread
+    while the workers are forked and evaluate, so the workers never hand work to a pool
+    whose threads did not survive the fork. The pool threads are idle between calls and
+    the evaluation does not enter the models' libraries, so no lock they hold is needed
+    by the workers.
+
+    Args:
+        feeds: Feeds to evaluate
+        max_size: If given, every feed is also evaluated at sizes up to max_size, see Feed.evaluate_range
+        samples: Number of sizes evaluated up to max_size
+        workers: Number of worker processes
+
+    Returns:
+        The range results of all feeds
+    """
+    if workers <= 1:
+        return [r for feed in feeds for r in evaluate_feed(feed, max_size, samples)]
+    inherited_feeds[:] = feeds
+    try:
+        with threadpool_limits(1), warnings.catch_warnings(), ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork")) as pool:
+            # Python warns about forking a multithreaded process, which is safe here, see above
+            warnings.filterwarnings("ignore", message=r".*use of fork\(\) may lead to deadlocks", category=DeprecationWarning)
+            futures = [pool.submit(evaluate_inherited, idx, max_size, samples) for idx in range(len(feeds))]
+            results = []
+            for feed, future in zip(feeds, futures):
+                feed_results, feed.metrics, feed.size, feed.ranked = future.result()
+                results.extend(feed_results)
+    finally:
+        inherited_feeds.clear()
+    return results
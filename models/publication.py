@@ -0,0 +1,116 @@
+import json
+import os
+
+from models.consts import SNAPSHOT_INTERVAL
+
+
+def write_text(path: str, text: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class Publication:
+    """
+    Versioned publication of one feed (model and size) as deltas between consecutive days.
+
+    Every published day gets the next version number and a delta file listing the added
+    ("+ip") and removed ("-ip") entries compared to the previous version. Every
+    SNAPSHOT_INTERVAL versions, and for the first version, a full snapshot is written too,
+    so consumers can catch up from any earlier version by loading the newest snapshot they
+    need and applying the deltas after it. The state is described by manifest.json.
+
+    Attributes:
+        directory (str): Directory holding the files of this feed
+        manifest (dict): Current version and one record per published version
+    """
+
+    def __init__(self, publish_dir: str, name: str, size: int):
+        self.directory = os.path.join(publish_dir, f"{name.replace(" ", "_").lower()}_{size}")
+        try:
+            with open(os.path.join(self.directory, "manifest.json")) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {"version": 0, "versions": []}
+
+    @property
+    def version(self) -> int:
+        return self.manifest["version"]
+
+    def path(self, version: int, kind: str) -> str:
+        return os.path.join(self.directory, f"v{version:05d}.{kind}.txt")
+
+    def read(self, version: int, kind: str) -> list[str]:
+        with open(self.path(version, kind)) as f:
+            return f.read().split()
+
+    def publish(self, ips: list[str], date: str) -> dict | None:
+        """
+        Publish the list of a day as new version.
+
+        Args:
+            ips: IPs of the feed in feed order
+            date: Date of the data the feed was generated from
+
+        Returns:
+            The record of the new version, or None if this date was published already
+        """
+        if any(v["date"] == date for v in self.manifest["versions"]):
+            print(f"{self.directory} already contains {date}, skipping")
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        # rebuilt from the files the manifest lists, current.txt may be ahead of it after a crash
+        previous = self.catch_up()[0]
+        new = set(ips)
+        added, removed = sorted(new - previous), sorted(previous - new)
+
+        version = self.version + 1
+        record = {"version": version, "date": date, "size": len(new), "added": len(added), "removed": len(removed), "snapshot": False}
+        write_text(self.path(version, "delta"), "".join(f"+{ip}\n" for ip in added) + "".join(f"-{ip}\n" for ip in removed))
+        if version == 1 or version % SNAPSHOT_INTERVAL == 0:
+            write_text(self.path(version, "snapshot"), "\n".join(ips))
+            record["snapshot"] = True
+        self.manifest["version"] = version
+        self.manifest["versions"].append(record)
+        # the manifest is written after the version's files, so readers never see a version whose files are missing
+        write_text(os.path.join(self.directory, "manifest.json"), json.dumps(self.manifest, indent=2))
+        write_text(os.path.join(self.directory, "current.txt"), "\n".join(ips))
+        return record
+
+    def catch_up(self, ips: set[str] = None, version: int = 0) -> tuple[set[str], int]:
+        """
+        Bring a consumer's copy of the list to the current version.
+
+        Starts from the consumer's copy, or from the newest snapshot if there is no copy or
+        loading the snapshot and the deltas after it means reading fewer entries. An empty
+        copy counts as no copy, whatever its version.
+
+        Args:
+            ips: The consumer's copy of the list
+            version: The version of the consumer's copy
+
+        Returns:
+            The current list and its version
+        """
+        if version > self.version:
+            raise ValueError(f"{self.directory} has no version {version}, the current version is {self.version}")
+        if self.version == 0:
+            return set(), 0
+
+        def delta_cost(start: int) -> int:
+            return sum(v["added"] + v["removed"] for v in self.manifest["versions"] if v["version"] > start)
+
+        # the first version is always a snapshot
+        snapshot = [v for v in self.manifest["versions"] if v["snapshot"]][-1]
+        if not ips or (snapshot["version"] > version and snapshot["size"] + delta_cost(snapshot["version"]) < delta_cost(version)):
+            version = snapshot["version"]
+            ips = self.read(version, "snapshot")
+        ips = set(ips)
+        for v in range(version + 1, self.version + 1):
+            for line in self.read(v, "delta"):
+                if line[0] == "+":
+                    ips.add(line[1:])
+                else:
+                    ips.discard(line[1:])
+        return ips, self.version
@@ -1,6 +1,9 @@
-from models.base_model import Classifier, Regressor
-from models.consts import IP_REPUTATIONS, ML_FEATURES, MULTI_VAL_FEATURES
-from models.utils import multi_label_encode, one_hot_encode
+import time
+
+import numpy as np
+from models.base_model import Classifier, MLModel, Regressor
+from models.consts import FOREST_GROWTH_STEP, FOREST_PATIENCE, IP_REPUTATIONS, MIN_IMPROVEMENT, ML_FEATURES, MULTI_VAL_FEATURES
+from models.utils import multi_label_encode, one_hot_encode, recall_auc_score
 from scipy.stats import randint
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.model_selection import train_test_split
@@ -14,7 +17,96 @@ COMMON_SEARCH_PARAMS = {
 }
 
 
+def replace_oldest_trees(model, X, y, fraction: float, sample_weight=None):
+    """
+    Update a fitted forest with new data by replacing a slice of its trees.
+
+    A fraction of trees is grown on the new data and the same number of the oldest
+    trees is dropped, so the forest keeps its size and gradually forgets older days.
+
+    Args:
+        model: A fitted RandomForestClassifier or RandomForestRegressor
+        X: Training features of the new day, aligned to the model's features
+        y: Training targets of the new day
+        fraction: Share of the trees to replace
+        sample_weight: Optional weights of the training examples
+
+    Returns:
+        The updated forest
+    """
+    n_new = max(round(model.n_estimators * fraction), 1)
+    model.set_params(warm_start=True, n_estimators=model.n_estimators + n_new)
+    model.fit(X, y, sample_weight=sample_weight)
+    model.estimators_ = model.estimators_[n_new:]
+    model.set_params(warm_start=False, n_estimators=len(model.estimators_))
+    return model
+
+
+def grow_trees(ml_model: MLModel, model, X_train, y_train, X_val=None, y_val=None, sample_weight=None):
+    """
+    Fit a forest by growing its trees in steps of FOREST_GROWTH_STEP.
+
+    Growing stops once the model's time budget is used up or, if a validation set is
+    given, once the recall AUC on it did not improve for FOREST_PATIENCE steps. In the
+    latter case the forest is cut back to the number of trees with the best score.
+    Tree predictions on the validation set are accumulated, so every step only scores
+    the newly grown trees.
+
+    Args:
+        ml_model: The model being trained, providing the time budget and predict_scores
+        model: An unfitted RandomForestClassifier or RandomForestRegressor
+        X_train: Training features
+        y_train: Training targets
+        X_val: Optional validation features for early stopping
+        y_val: Optional validation targets for early stopping
+        sample_weight: Optional weights of the training examples
+
+    Returns:
+        The fitted forest
+    """
+    if X_val is None and ml_model.time_budget is None:
+        return model.fit(X_train, y_train, sample_weight=sample_weight)
+    deadline = None if ml_model.time_budget is None else time.monotonic() + ml_model.time_budget
+    n_target = model.n_estimators
+    if X_val is not None:
+        X_val = np.asarray(X_val, dtype=np.float32)
+        val_scores = np.zeros(len(X_val))
+    best_score, best_n, stale = -np.inf, 0, 0
+    model.set_params(warm_start=True)
+    for n in range(FOREST_GROWTH_STEP, n_target + FOREST_GROWTH_STEP, FOREST_GROWTH_STEP):
+        n_grown = len(getattr(model, "estimators_", []))
+        model.set_params(n_estimators=min(n, n_target))
+        model.fit(X_train, y_train, sample_weight=sample_weight)
+        if X_val is not None:
+            for tree in model.estimators_[n_grown:]:
+                val_scores += ml_model.predict_scores(tree, X_val)
+            score = recall_auc_score(y_val, val_scores)
+            if score > best_score + MIN_IMPROVEMENT:
+                best_score, best_n, stale = score, len(model.estimators_), 0
+            else:
+                stale += 1
+            if stale >= FOREST_PATIENCE:
+                break
+        if deadline is not None and time.monotonic() > deadline:
+            print(f"time budget of {ml_model.name} used up after {len(model.estimators_)} trees")
+            break
+    if X_val is not None:
+        model.estimators_ = model.estimators_[:best_n]
+    model.set_params(warm_start=False, n_estimators=len(model.estimators_))
+    return model
+
+
 class RFClassifier(Classifier):
+    params = {
+        "class_weight": {False: 1, True: 8},
+        "criterion": "log_loss",
+        "max_depth": 18,
+        "max_features": "log2",
+        "min_samples_leaf": 9,
+        "min_samples_split": 8,
+        "n_estimators": 389,
+    }
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + ["ip_reputation"]
@@ -35,7 +127,7 @@ class RFClassifier(Classifier):
         }
         self.random_search(RandomForestClassifier(), param_dist, X, y)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         y = df["interactions_on_eval_day"] > 0
 
@@ -48,38 +140,45 @@ class RFClassifier(Classifier):
             self.hyper_param_search(X, y)
             return
 
-        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+        previous, _ = self.load_previous() if warm_start else (None, None)
+        if previous is not None:
+            X = self.align_features(X, previous)
 
-        params = {
-            "class_weight": {False: 1, True: 8},
-            "criterion": "log_loss",
-            "max_depth": 18,
-            "max_features": "log2",
-            "min_samples_leaf": 9,
-            "min_samples_split": 8,
-            "n_estimators": 389,
-        }
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+        X_train, X_val, y_train, y_val = self.validation_split(X_train, y_train)
 
         model = RandomForestClassifier(
             random_state=42,
             n_jobs=-1,
-            **params,
+            **self.params,
         )
-        model.fit(X_train, y_train)
-        self.report(model, X_test, y_test, X.columns)
+        X_train, y_train, sample_weight = self.downsample_negatives(X_train, y_train)
+        if previous is not None:
+            model = replace_oldest_trees(previous, X_train, y_train, self.warm_start_fraction, sample_weight)
+        else:
+            model = grow_trees(self, model, X_train, y_train, X_val, y_val, sample_weight)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
         self.save(model)
+        return recall_auc
 
-    def execute(self, df):
-        model, _ = self.load()
+    def encode(self, df):
         X = df[self.features]
         X = one_hot_encode(X, "ip_reputation", IP_REPUTATIONS)  # , remove=False)
         for feature in MULTI_VAL_FEATURES:
             X = multi_label_encode(X, feature)
-        df[self.sort_key] = model.predict_proba(X)[:, 1]
-        return df
+        return X
 
 
 class RFRegressor(Regressor):
+    params = {
+        "criterion": "squared_error",
+        "max_depth": 33,
+        "max_features": "sqrt",
+        "min_samples_leaf": 5,
+        "min_samples_split": 15,
+        "n_estimators": 122,
+    }
+
     def __init__(self, definition):
         super().__init__(definition)
         self.features = ML_FEATURES + MULTI_VAL_FEATURES + ["ip_reputation"]
@@ -98,7 +197,7 @@ class RFRegressor(Regressor):
         }
         self.random_search(RandomForestRegressor(), param_dist, X, y)
 
-    def train(self, df, search=False):
+    def train(self, df, search=False, warm_start=False):
         X = df[self.features]
         y = df["interactions_on_eval_day"]
 
@@ -111,30 +210,29 @@ class RFRegressor(Regressor):
             self.hyper_param_search(X, y)
             return
 
+        previous, _ = self.load_previous() if warm_start else (None, None)
+        if previous is not None:
+            X = self.align_features(X, previous)
+
         X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+        X_train, X_val, y_train, y_val = self.validation_split(X_train, y_train)
 
-        params = {
-            "criterion": "squared_error",
-            "max_depth": 33,
-            "max_features": "sqrt",
-            "min_samples_leaf": 5,
-            "min_samples_split": 15,
-            "n_estimators": 122,
-        }
         model = RandomForestRegressor(
             random_state=42,
             n_jobs=-1,
-            **params,
+            **self.params,
         )
-        model.fit(X_train, y_train)
-        self.report(model, X_test, y_test, X.columns)
+        if previous is not None:
+            model = replace_oldest_trees(previous, X_train, y_train, self.warm_start_fraction)
+        else:
+            model = grow_trees(self, model, X_train, y_train, X_val, y_val)
+        recall_auc = self.report(model, X_test, y_test, X.columns)
         self.save(model)
+        return recall_auc
 
-    def execute(self, df):
-        model, _ = self.load()
+    def encode(self, df):
         X = df[self.features]
         X = one_hot_encode(X, "ip_reputation", IP_REPUTATIONS)  # , remove=False)
         for feature in MULTI_VAL_FEATURES:
             X = multi_label_encode(X, feature)
-        df[self.sort_key] = model.predict(X)
-        return df
+        return X
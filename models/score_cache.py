@@ -0,0 +1,67 @@
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from models.consts import SCORE_CACHE_DIR
+
+
+def dump_hash(file_path: str, **options) -> str:
+    """
+    Hash the content of a GreedyBear dump together with the options it was read with.
+
+    Args:
+        file_path: Path to the dump
+        **options: Options that change the rows read from the dump, e.g. exclude_mass_scanners
+
+    Returns:
+        Hex digest identifying the scored rows
+    """
+    with open(file_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256")
+    digest.update(repr(sorted(options.items())).encode())
+    return digest.hexdigest()
+
+
+class ScoreCache:
+    """
+    Score columns of a scored dump, stored per model so repeated evaluations of the same dump skip scoring.
+
+    Entries are keyed by the dump's hash and the model's cache_key, which covers the content
+    of its trained artifact. Retraining a model therefore invalidates its entries without any
+    bookkeeping; stale entries are simply never read again.
+
+    Attributes:
+        directory (str): Directory holding the entries of the dump
+    """
+
+    def __init__(self, dump_key: str, cache_dir: str = SCORE_CACHE_DIR):
+        self.directory = os.path.join(cache_dir, dump_key)
+
+    def path(self, model) -> str:
+        return os.path.join(self.directory, f"{model.sort_key}_{model.cache_key()[:16]}.npz")
+
+    def load(self, model, df: pd.DataFrame) -> bool:
+        """
+        Copy the cached score columns of a model into df.
+
+        Returns:
+            True if the scores were cached, False if the model has to be executed
+        """
+        try:
+            entry = np.load(self.path(model), allow_pickle=True)
+        except (FileNotFoundError, ValueError):
+            return False
+        if not np.array_equal(entry["value"], df["value"].to_numpy()):
+            return False
+        for column in model.score_columns():
+            df[column] = entry[column]
+        return True
+
+    def store(self, model, df: pd.DataFrame):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(model)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, value=df["value"].to_numpy(), **{column: df[column].to_numpy() for column in model.score_columns()})
+        os.replace(tmp_path, path)
@@ -0,0 +1,98 @@
+import zlib
+
+import numpy as np
+import pandas as pd
+from models.feed import EvaluationSet, Feed
+from models.utils import ipv4_to_int
+
+# features relative to the reference day, which is only known after all records were read
+REFERENCE_DAY_FEATURES = ["days_since_last_seen", "days_since_first_seen"]
+
+
+def shard_of(values: list[str], shards: int) -> np.ndarray:
+    """
+    Shard of every IOC, given by the /24 prefix of IPv4 addresses and by the whole value otherwise.
+
+    Args:
+        values: IP addresses
+        shards: Number of shards
+
+    Returns:
+        Shard index per value
+    """
+    ips = ipv4_to_int(values)
+    prefixes = ips >> 8
+    for i in np.flatnonzero(ips < 0):
+        prefixes[i] = zlib.crc32(str(values[i]).encode()) >> 8
+    # multiplicative hashing spreads neighbouring prefixes evenly over the shards, its high bits
+    # select the shard, as the low bits only depend on the low bits of the prefix
+    return (prefixes * 2654435761 % (1 << 32)) * shards >> 32
+
+
+def feature_extremes(features: pd.DataFrame) -> pd.DataFrame:
+    """
+    Column-wise minimum and maximum of the numeric features that do not depend on the reference day.
+
+    The extremes of all shards combine into a two-row frame holding the value ranges of the whole
+    dump, which models normalising with the value ranges of the scored rows get as reference,
+    see Model.fix_reference.
+    """
+    return features.drop(columns=REFERENCE_DAY_FEATURES).select_dtypes("number").agg(["min", "max"])
+
+
+def feed_part_columns(sort_key: str, has_coa: bool) -> list[str]:
+    """Columns of the rows of a feed part, which the merged feed is created from."""
+    columns = ["value", "position", "interactions_on_eval_day", sort_key] + (["coa_score"] if has_coa else [])
+    return list(dict.fromkeys(columns))
+
+
+def feed_part(feed: Feed, k: int) -> dict:
+    """
+    The part of a feed over one shard that is needed to evaluate the feed over all shards.
+
+    The global top-k is contained in the union of the top-k of every shard. Metrics further
+    need the number of evaluation IPs and interactions that are not among these rows, which
+    are kept as totals.
+
+    Args:
+        feed: Feed over the rows of one shard, with exclusions applied
+        k: Largest size the merged feed is evaluated at
+
+    Returns:
+        The top-k rows of the shard and the totals of the feed
+    """
+    interactions = feed.base["interactions_on_eval_day"].to_numpy()[feed.included]
+    return {
+        "rows": feed.top(k)[feed_part_columns(feed.sort_key, feed.has_coa)],
+        "known_ip_count": feed.known_ip_count,
+        "ip_count": np.count_nonzero(interactions > 0) + feed.fn_ips_count,
+        "interaction_count": interactions.sum() + feed.fn_ias_count,
+    }
+
+
+def empty_feed_part(evaluation: EvaluationSet, sort_key: str, has_coa: bool = False) -> dict:
+    """The part of a feed over a shard without any scored rows, which misses all evaluation IPs of the shard."""
+    ip_count, interaction_count = evaluation.missing([])
+    dtypes = {"value": object, "position": np.int64, "interactions_on_eval_day": np.int64}
+    rows = pd.DataFrame({column: pd.Series(dtype=dtypes.get(column, float)) for column in feed_part_columns(sort_key, has_coa)})
+    return {"rows": rows, "known_ip_count": 0, "ip_count": ip_count, "interaction_count": interaction_count}
+
+
+def merge_feed_parts(name: str, sort_key: str, parts: list[dict], size: int) -> Feed:
+    """
+    Combine the parts of a feed over all shards into the feed over the whole dump.
+
+    The rows are put back into their order in the dump, so ties are broken as if the dump was
+    scored at once. Evaluation IPs and interactions outside the top rows of the shards count as
+    missing, so the merged feed's metrics equal the ones of the unsharded feed up to the largest
+    size the parts were created for.
+    """
+    # empty parts are left out of the concatenation, unless the feed has no rows in any shard
+    frames = [part["rows"] for part in parts if len(part["rows"])] or [parts[0]["rows"]]
+    rows = pd.concat(frames).sort_values("position").reset_index(drop=True)
+    feed = Feed(name, data=rows, size=size, sort_key=sort_key)
+    interactions = rows["interactions_on_eval_day"].to_numpy()
+    feed.known_ip_count = sum(part["known_ip_count"] for part in parts)
+    feed.fn_ips_count = sum(part["ip_count"] for part in parts) - np.count_nonzero(interactions > 0)
+    feed.fn_ias_count = sum(part["interaction_count"] for part in parts) - interactions.sum()
+    return feed
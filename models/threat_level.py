@@ -1,4 +1,6 @@
+import hashlib
 import json
+import time
 
 import numpy as np
 import requests
@@ -12,6 +14,8 @@ WEIGHTS = {
     "breadth": 0.25,
 }
 
+ASN_LIST_MAX_AGE = 24 * 60 * 60  # seconds
+
 SIGMOID_CENTER = 3
 LOGIN_NORM_FACTOR = 8
 
@@ -41,11 +45,14 @@ class ThreatLevel(Model):
 
     Attributes:
         high_risk_asns (set): Set of ASNs identified as high-risk by Spamhaus
+        asn_list_fetched_at (float): Time of the last successful fetch of the ASN list
     """
 
     def __init__(self, definition):
         super().__init__(definition)
+        self.features = ["login_attempts", "days_seen_count", "active_days_ratio", "asn", "destination_port_count", "days_since_last_seen"]
         self.high_risk_asns = set()
+        self.asn_list_fetched_at = None
 
     def fetch_asn_list(self) -> None:
         """
@@ -62,6 +69,7 @@ class ThreatLevel(Model):
             response = requests.get(URL, timeout=10)
             asn_list = [json.loads(line) for line in response.text.splitlines()]
             self.high_risk_asns = {str(d["asn"]) for d in asn_list if "asn" in d}
+            self.asn_list_fetched_at = time.monotonic()
         except Exception as e:
             # logger.error(f"Failed to fetch ASN-DROP list: {str(e)}")
             print("FAIL")
@@ -115,7 +123,19 @@ class ThreatLevel(Model):
         aging_factor = 2 / (2 + ioc["days_since_last_seen"])
         return aging_factor * total_score
 
+    def refresh_asn_list(self) -> None:
+        if self.asn_list_fetched_at is None or time.monotonic() - self.asn_list_fetched_at > ASN_LIST_MAX_AGE:
+            self.fetch_asn_list()
+
+    def preload(self):
+        self.refresh_asn_list()
+
+    def cache_key(self) -> str:
+        # the scores change with the ASN-DROP list, so it is part of the key
+        self.refresh_asn_list()
+        return hashlib.sha256(json.dumps(sorted(self.high_risk_asns)).encode()).hexdigest()
+
     def execute(self, df):
-        self.fetch_asn_list()
+        self.refresh_asn_list()
         df["tl_score"] = df.apply(self.threat_level, axis=1)
         return df
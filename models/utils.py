@@ -1,11 +1,16 @@
 import json
+import resource
+import socket
 import sys
+import tracemalloc
 from datetime import date
 from functools import cache
 
 import numpy as np
 import pandas as pd
 import plotly.express as px
+from greedybear_utils import calculate_interaction_delta, read_dump
+from models.consts import SAMPLE_COUNT
 
 
 @cache
@@ -70,13 +75,14 @@ def correlation_analysis(df: pd.DataFrame, features: list[str], threshold: float
             print(f"{f1} & {f2}: {corr:.2f}")
 
 
-def get_features(iocs: list[dict], reference_day: str) -> pd.DataFrame:
+def get_features(iocs: list[dict], reference_day: str, analyze: bool = True) -> pd.DataFrame:
     """
     Extract and calculate features from IOC data.
 
     Args:
         iocs: List of IOC dictionaries with required fields
         reference_day: Reference date for time-based calculations
+        analyze: Whether to report highly correlated features, disable for small batches
 
     Returns:
        DataFrame containing metadata and calculated features for each IOC
@@ -116,10 +122,165 @@ def get_features(iocs: list[dict], reference_day: str) -> pd.DataFrame:
             }
         )
     df = pd.DataFrame(result)
-    correlation_analysis(df, list(result[0].keys())[FEATURES_OFFSET:])
+    if analyze:
+        correlation_analysis(df, list(result[0].keys())[FEATURES_OFFSET:])
     return df
 
 
+def build_scoring_df(score_file: str, eval_file: str) -> tuple[pd.DataFrame, dict]:
+    """
+    Build the feature frame of a day to be scored, labelled with the interactions of the following day.
+
+    Args:
+        score_file: Path to the dump that is scored
+        eval_file: Path to the dump of the following day
+
+    Returns:
+        The scoring DataFrame and the interaction delta between both days
+    """
+    scoring_data = read_dump(score_file)
+    scoring_data_date = max(row["last_seen"] for row in scoring_data)
+    interaction_delta = calculate_interaction_delta(scoring_data, scoring_data_date, read_dump(eval_file))
+    scoring_df = get_features(scoring_data, scoring_data_date)
+    scoring_df["interactions_on_eval_day"] = scoring_df["value"].map(lambda ip: interaction_delta[ip])
+    return scoring_df, interaction_delta
+
+
+def recall_auc_score(y_true, y_score) -> float:
+    """
+    Calculate the area under the recall curve for top-k predictions.
+
+    Ranks all instances by score and computes the recall of the top k instances at
+    SAMPLE_COUNT evenly spaced depths k, using a single cumulative sum.
+
+    Args:
+        y_true: Target values, either booleans or interaction counts
+        y_score: Predicted scores, higher values are ranked first
+
+    Returns:
+        A score between 0 and 1, where 1 means perfect ranking (all positive
+        instances are ranked before negative ones).
+    """
+    y_true = np.asarray(y_true, dtype=float)
+    max_k = len(y_true)
+    cumulative = np.cumsum(y_true[np.argsort(-np.asarray(y_score, dtype=float), kind="stable")])
+    step_size = max(max_k // SAMPLE_COUNT, 1)
+    k_values = np.minimum(np.arange(step_size, max_k + step_size, step_size), max_k)
+    recalls = cumulative[k_values - 1] / cumulative[-1]
+    return np.trapz(np.concatenate([[0], recalls])) / SAMPLE_COUNT
+
+
+def ipv4_to_int(ips) -> np.ndarray:
+    """
+    Convert IPv4 addresses to integers, e.g. for sorting and vectorized set operations.
+
+    Strings are parsed together on a fixed-width byte view of all of them instead of one
+    inet_pton call each. Inputs that do not convert to ASCII bytes are converted one by one.
+
+    Args:
+        ips: Iterable of IP address strings, integer arrays are returned unchanged
+
+    Returns:
+        Array of integers, -1 for values that are not valid IPv4 addresses
+    """
+    if isinstance(ips, np.ndarray) and np.issubdtype(ips.dtype, np.integer):
+        return ips.astype(np.int64)
+    if not isinstance(ips, np.ndarray):
+        ips = list(ips)
+    try:
+        # 16 bytes hold the longest address (15 characters) plus one to detect longer values
+        raw = np.asarray(ips, dtype="S16")
+    except (UnicodeEncodeError, ValueError):
+        return np.fromiter((ipv4_to_int_single(ip) for ip in ips), dtype=np.int64)
+    return parse_ipv4(raw.view(np.uint8).reshape(len(raw), 16))
+
+
+def ipv4_to_int_single(ip) -> int:
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+    except (OSError, TypeError, ValueError):
+        return -1
+
+
+def parse_ipv4(chars: np.ndarray) -> np.ndarray:
+    """
+    Parse IPv4 addresses given as rows of zero-padded ASCII bytes, with the rules of inet_pton.
+
+    Every octet needs one to three digits without leading zeros and a value up to 255. The
+    bytes are consumed one column at a time for all addresses at once, an octet is shifted
+    into the result at the dot or the end of the address that closes it.
+    """
+    n = len(chars)
+    values, octet = np.zeros(n, dtype=np.uint32), np.zeros(n, dtype=np.uint16)
+    digits, dots = np.zeros(n, dtype=np.uint8), np.zeros(n, dtype=np.uint8)
+    ended = np.zeros(n, dtype=bool)
+    valid = chars[:, -1] == 0
+    for c in np.ascontiguousarray(chars.T):
+        digit = c - np.uint8(ord("0"))
+        is_digit, is_dot, is_end = digit < 10, c == ord("."), c == 0
+        valid &= (is_digit | is_dot | is_end) & (is_end | ~ended)
+        # a digit after a single zero is a leading zero
+        valid &= ~(is_digit & (digits == 1) & (octet == 0))
+        octet = np.where(is_digit, octet * np.uint16(10) + digit, octet)
+        digits += is_digit
+        closed = is_dot | (is_end & ~ended)
+        # digits - 1 wraps around for octets without digits
+        valid &= ~closed | ((digits - np.uint8(1) < 3) & (octet <= 255))
+        values = np.where(closed, (values << np.uint32(8)) | octet, values)
+        octet *= ~closed
+        digits *= ~closed
+        dots += is_dot
+        ended |= is_end
+    return np.where(valid & (dots == 3), values.astype(np.int64), -1)
+
+
+def peak_memory_mb() -> float:
+    """
+    Peak resident set size of the current process so far, including loading and featurizing the dumps.
+
+    Returns:
+        Peak memory usage in MiB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def proc_status_kb(field: str) -> int:
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(f"{field}:"))
+
+
+class MemoryPeak:
+    """
+    Context manager measuring the peak memory allocated while its block runs.
+
+    On Linux the peak resident set size of the process is reset on entry, so native
+    allocations such as those of CatBoost are included. Elsewhere, the peak of the
+    allocations traced by tracemalloc is reported, which covers Python objects and
+    NumPy arrays only. Memory used by worker processes is not included.
+
+    Attributes:
+        mb (float): Peak memory allocated above the usage on entry in MiB
+    """
+
+    def __enter__(self):
+        self.mb = None
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            self.start_kb = proc_status_kb("VmRSS")
+        except OSError:
+            self.start_kb = None
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start_kb is None:
+            self.mb = tracemalloc.get_traced_memory()[1] / 2**20
+            tracemalloc.stop()
+        else:
+            self.mb = (proc_status_kb("VmHWM") - self.start_kb) / 1024
+
+
 def load_coa_data(file_path: str) -> dict:
     """
     Load and process Confidence of Abuse (CoA) data from a JSON file.
@@ -143,6 +304,21 @@ def load_coa_data(file_path: str) -> dict:
     return coa_data
 
 
+def join_coa_scores(df: pd.DataFrame, coa_scores: dict) -> pd.DataFrame:
+    """
+    Add the confidence of abuse score of every IP as column 'coa_score', 0 for unknown IPs.
+
+    Args:
+        df: DataFrame with a 'value' column containing IPs
+        coa_scores: Mapping from IPs to their confidence of abuse scores, as returned by load_coa_data
+
+    Returns:
+        The DataFrame with the additional column
+    """
+    df["coa_score"] = df["value"].map(coa_scores).fillna(0).to_numpy(dtype=float)
+    return df
+
+
 def load_csv(file_path: str) -> pd.DataFrame:
     """
     Loads a CSV file and renames the 'ip' column to 'value'.
@@ -175,7 +351,7 @@ def load_txt(file_path: str) -> pd.DataFrame:
     return pd.DataFrame(entries)
 
 
-def min_max_normalize(df: pd.DataFrame, target_cols: list[str], lower_is_better: set[str]) -> pd.DataFrame:
+def min_max_normalize(df: pd.DataFrame, target_cols: list[str], lower_is_better: set[str], bounds: dict = None) -> pd.DataFrame:
     """
     Normalizes specified columns in a pandas DataFrame using min-max scaling, with special handling for metrics where lower values are better.
 
@@ -186,14 +362,15 @@ def min_max_normalize(df: pd.DataFrame, target_cols: list[str], lower_is_better:
         df (pandas.DataFrame): Input DataFrame containing the columns to be normalized
         target_cols (list): List of column names to normalize. Each column must exist in df
         lower_is_better (set): Columns where lower values are better
+        bounds (dict): Optional (min, max) per column to scale with instead of the column's own range,
+            so rows can be normalized consistently with a reference DataFrame
 
     Returns:
         A new pandas DataFrame containing only the normalized columns. Original DataFrame remains unchanged
     """
     result = pd.DataFrame(index=df.index)
     for col in target_cols:
-        min_val = df[col].min()
-        max_val = df[col].max()
+        min_val, max_val = bounds[col] if bounds is not None else (df[col].min(), df[col].max())
         if min_val == max_val:
             result[col] = 1.0
             continue
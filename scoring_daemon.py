@@ -0,0 +1,227 @@
+"""
+Scoring daemon
+
+Long-lived local HTTP service that loads all models from MODEL_DEFINITIONS once and
+keeps them resident, so scoring requests do not pay for interpreter startup, library
+imports, artifact loading and fetching the ASN list.
+Model artifacts are reloaded automatically once they have been retrained.
+
+Usage:
+    python scoring_daemon.py [--port 8765] [--scoring-data gbdump.json]
+
+Endpoints:
+    POST /score   JSON body {"dump": "<path>"} scores a GreedyBear dump and keeps it as
+                  current ranking, {"iocs": [...], "reference_day": "YYYY-MM-DD"} scores
+                  a batch of IOC records. Both return the top-k of every feed.
+    POST /update  JSON body {"iocs": [...]} applies new or updated IOC records to the current
+                  ranking without rescoring the dump and returns the IPs that entered and
+                  left every feed.
+    GET  /feeds   Top-k of every feed of the current ranking, including updates. Sizes above
+                  the k the dump was scored with are served from the dump alone.
+    GET  /ip/<ip> Scores and feed ranks of a single IP of the scored dump, no rank if the
+                  IP is excluded from a feed.
+
+    All endpoints accept the query parameter k (default: 5000). Like the evaluated feeds,
+    all feeds leave out the IOCs GreedyBear does not list (see models.feed.exclusions).
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+from evaluate_single_day import calculate_scores
+from greedybear_utils import read_dump
+from models.base_model import Model
+from models.consts import DEFAULT_K, NON_SCORING_KEYS
+from models.feed import exclusions
+from models.incremental import IncrementalRanking
+from models.model_definitions import MODEL_DEFINITIONS
+from models.utils import get_features
+
+
+class ScoringService:
+    """
+    Holds the resident models and the most recently scored dump.
+
+    Attributes:
+        models (list): Instantiated models from MODEL_DEFINITIONS
+        scored_df (pd.DataFrame): Scored features of the current dump, indexed by IP
+        date (str): Date of the current dump
+        ranking (IncrementalRanking): Top-k of every feed of the current dump, kept up to date with streamed updates
+    """
+
+    def __init__(self):
+        self.models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS]
+        for model in self.models:
+            model.preload()
+        self.feed_models = [m for m in self.models if m.sort_key not in NON_SCORING_KEYS]
+        self.scored_df = None
+        self.date = None
+        self.ranking = None
+        self.lock = threading.Lock()
+
+    def score(self, iocs: list[dict], reference_day: str) -> pd.DataFrame:
+        scoring_df = get_features(iocs, reference_day)
+        with self.lock:
+            calculate_scores(self.models, scoring_df)
+        return scoring_df
+
+    def included(self, scored_df: pd.DataFrame, reference_day: str) -> dict[str, pd.DataFrame]:
+        """The rows of every feed, without the ones it excludes."""
+        excluded = exclusions(scored_df, reference_day)
+        return {m.name: scored_df[~excluded[m.name]] if m.name in excluded else scored_df for m in self.feed_models}
+
+    def top_k(self, scored_df: pd.DataFrame, k: int, reference_day: str) -> dict[str, list[str]]:
+        rows = self.included(scored_df, reference_day)
+        return {m.name: rows[m.name].sort_values(by=m.sort_key, ascending=False, kind="stable")["value"].head(k).to_list() for m in self.feed_models}
+
+    def score_dump(self, file_path: str, k: int) -> dict:
+        iocs = read_dump(file_path)
+        date = max(ioc["last_seen"] for ioc in iocs)
+        scored_df = self.score(iocs, date)
+        rows = self.included(scored_df, date)
+        for m in self.feed_models:
+            order = rows[m.name][m.sort_key].sort_values(ascending=False, kind="stable").index
+            scored_df.loc[order, f"{m.sort_key}_rank"] = range(1, len(order) + 1)
+        # separate instances, as fix_reference changes how the models score later batches
+        streaming_models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS if d["sort_key"] not in NON_SCORING_KEYS]
+        for model in streaming_models:
+            model.preload()
+        ranking = IncrementalRanking(streaming_models, scored_df, date, k)
+        # swapped in together, so readers never pair the date of one dump with the ranking of another
+        with self.lock:
+            self.scored_df, self.date, self.ranking = scored_df.set_index("value", drop=False), date, ranking
+        return {"date": date, "records": len(scored_df), "feeds": self.top_k(scored_df, k, date)}
+
+    def score_batch(self, iocs: list[dict], reference_day: str, k: int) -> dict:
+        scored_df = self.score(iocs, reference_day)
+        scores = scored_df[["value"] + [m.sort_key for m in self.feed_models]]
+        return {"scores": json.loads(scores.to_json(orient="records")), "feeds": self.top_k(scored_df, k, reference_day)}
+
+    def current_feeds(self, k: int) -> dict:
+        # the incremental feeds are read under the lock, as /update changes them from other threads
+        with self.lock:
+            scored_df, date = self.scored_df, self.date
+            if k <= self.ranking.k:
+                return {"date": date, "feeds": {name: feed.feed()[:k] for name, feed in self.ranking.feeds.items()}}
+        return {"date": date, "feeds": self.top_k(scored_df, k, date)}
+
+    def update(self, iocs: list[dict]) -> dict:
+        with self.lock:
+            return {"date": self.date, "changes": self.ranking.ingest(iocs)}
+
+    def lookup(self, ip: str) -> dict:
+        with self.lock:
+            scored_df, date = self.scored_df, self.date
+        row = scored_df.loc[ip]
+        return {
+            "value": ip,
+            "date": date,
+            "scores": {m.name: row[m.sort_key] for m in self.feed_models},
+            "ranks": {m.name: None if pd.isna(row[f"{m.sort_key}_rank"]) else int(row[f"{m.sort_key}_rank"]) for m in self.feed_models},
+        }
+
+
+def ioc_batch(content: dict) -> list[dict]:
+    iocs = content.get("iocs")
+    if not isinstance(iocs, list) or not iocs:
+        raise ValueError("'iocs' must be a non-empty list of IOC records")
+    return iocs
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    service: ScoringService = None
+
+    def respond(self, status: int, content: dict):
+        body = json.dumps(content, default=lambda o: o.item() if hasattr(o, "item") else str(o)).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, handler):
+        start = time.perf_counter()
+        url = urlparse(self.path)
+        try:
+            k = int(parse_qs(url.query).get("k", [DEFAULT_K])[0])
+            if k < 1:
+                raise ValueError("k must be positive")
+            result = handler(url.path, k)
+        except KeyError as e:
+            self.respond(404, {"error": f"not found: {e}"})
+            return
+        except (ValueError, OSError) as e:
+            self.respond(400, {"error": str(e)})
+            return
+        if result is None:
+            self.respond(404, {"error": f"unknown endpoint {url.path}"})
+            return
+        self.respond(200, result | {"seconds": time.perf_counter() - start})
+
+    def do_GET(self):
+        def handler(path, k):
+            if self.service.scored_df is None:
+                raise KeyError("no dump scored yet")
+            if path == "/feeds":
+                return self.service.current_feeds(k)
+            if path.startswith("/ip/"):
+                return self.service.lookup(path.removeprefix("/ip/"))
+            return None
+
+        self.handle_request(handler)
+
+    def do_POST(self):
+        def handler(path, k):
+            if path not in ("/score", "/update"):
+                return None
+            content = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if not isinstance(content, dict):
+                raise ValueError("the request body must be a JSON object")
+            if path == "/update":
+                if self.service.ranking is None:
+                    raise KeyError("no dump scored yet")
+                return self.service.update(ioc_batch(content))
+            if "dump" in content:
+                return self.service.score_dump(content["dump"], k)
+            if "iocs" in content:
+                if "reference_day" not in content:
+                    raise ValueError("scoring a batch of IOCs requires a 'reference_day'")
+                return self.service.score_batch(ioc_batch(content), content["reference_day"], k)
+            raise ValueError("request must contain either 'dump' or 'iocs'")
+
+        self.handle_request(handler)
+
+
+def run():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
+
+    parser.add_argument(
+        "--port",
+        help="Port to listen on (localhost only).",
+        type=int,
+        default=8765,
+    )
+
+    parser.add_argument(
+        "-s",
+        "--scoring-data",
+        help="Path to a .json dump that is scored on startup.",
+    )
+
+    config = vars(parser.parse_args())
+
+    ScoringRequestHandler.service = ScoringService()
+    if config["scoring_data"]:
+        ScoringRequestHandler.service.score_dump(config["scoring_data"], DEFAULT_K)
+
+    server = ThreadingHTTPServer(("127.0.0.1", config["port"]), ScoringRequestHandler)
+    print(f"listening on http://127.0.0.1:{config['port']}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run()
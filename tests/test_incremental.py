@@ -0,0 +1,44 @@
+import random
+import unittest
+
+import numpy as np
+from models.incremental import IncrementalFeed
+
+
+class IncrementalFeedTest(unittest.TestCase):
+    def expected(self, scores: dict, positions: dict, excluded: set, k: int) -> list[str]:
+        candidates = [ip for ip in scores if ip not in excluded]
+        return sorted(candidates, key=lambda ip: (-scores[ip], positions[ip]))[:k]
+
+    def test_updates_and_exclusions_match_full_ranking(self):
+        rng = random.Random(0)
+        ips = np.array([f"10.0.0.{i}" for i in range(200)], dtype=object)
+        # few distinct scores, so ties are broken by position
+        values = np.array([rng.randint(0, 20) for _ in ips], dtype=float)
+        excluded_mask = np.array([rng.random() < 0.2 for _ in ips])
+        feed = IncrementalFeed(ips, values, 25, excluded_mask)
+
+        scores = dict(zip(ips, values))
+        positions = {ip: i for i, ip in enumerate(ips)}
+        excluded = set(ips[excluded_mask])
+        self.assertEqual(feed.feed(), self.expected(scores, positions, excluded, 25))
+
+        for step in range(3000):
+            ip = f"10.0.{rng.randint(0, 1)}.{rng.randint(0, 255)}"
+            positions.setdefault(ip, len(positions))
+            before = set(feed.feed())
+            if rng.random() < 0.3:
+                entered, left = feed.exclude(ip)
+                excluded.add(ip)
+            else:
+                scores[ip] = float(rng.randint(0, 20))
+                entered, left = feed.update(ip, scores[ip])
+                excluded.discard(ip)
+            expected = self.expected({ip: s for ip, s in scores.items()}, positions, excluded, 25)
+            self.assertEqual(feed.feed(), expected, f"step {step}")
+            self.assertEqual(set(expected) - before, {entered} - {None})
+            self.assertEqual(before - set(expected), {left} - {None})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import threading
+import unittest
+import warnings
+
+import numpy as np
+import pandas as pd
+from models.feed import Feed
+from models.parallel import evaluate_feeds
+
+
+class ProcessRecordingFeed(Feed):
+    def evaluate(self):
+        super().evaluate()
+        self.metrics["pid"] = os.getpid()
+
+
+def feeds(n: int = 2000) -> list:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "value": [f"10.{i // 65536}.{i // 256 % 256}.{i % 256}" for i in range(n)],
+            "interactions_on_eval_day": rng.poisson(0.5, n),
+            "a": rng.random(n),
+            "b": rng.random(n),
+        }
+    )
+    eval_ips = {ip: v for ip, v in zip(df["value"], df["interactions_on_eval_day"]) if v > 0}
+    return [ProcessRecordingFeed(key, data=df, size=200, sort_key=key, eval_ips=eval_ips) for key in ["a", "b"]]
+
+
+class EvaluateFeedsTest(unittest.TestCase):
+    def test_workers_match_serial_evaluation(self):
+        serial, parallel = feeds(), feeds()
+        serial_results = evaluate_feeds(serial, 1000, 10)
+        # an idle thread stands in for the thread pools left behind by the models
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("error", DeprecationWarning)
+                parallel_results = evaluate_feeds(parallel, 1000, 10, workers=2)
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertEqual(parallel_results, serial_results)
+        for s, p in zip(serial, parallel):
+            self.assertNotEqual(p.metrics.pop("pid"), os.getpid())
+            self.assertEqual(s.metrics.pop("pid"), os.getpid())
+            self.assertEqual(p.metrics, s.metrics)
+            self.assertEqual(p.size, s.size)
+            np.testing.assert_array_equal(p.ranked, s.ranked)
+
+
+if __name__ == "__main__":
+    unittest.main()
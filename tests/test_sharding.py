@@ -0,0 +1,75 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from models.feed import EvaluationSet, Feed
+from models.sharding import empty_feed_part, feed_part, merge_feed_parts, shard_of
+
+
+def scored_frame(n: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            # three /24 prefixes, so most shards stay empty
+            "value": [f"10.0.{i % 3}.{i // 3}" for i in range(n)],
+            "position": np.arange(n),
+            "interactions_on_eval_day": rng.poisson(0.5, n),
+            "score": rng.random(n),
+        }
+    )
+
+
+class MergeFeedPartsTest(unittest.TestCase):
+    def setUp(self):
+        self.df = scored_frame(500)
+        eval_ips = dict(zip(self.df["value"], self.df["interactions_on_eval_day"]))
+        eval_ips["192.0.2.1"] = 3
+        self.eval_ips = {ip: v for ip, v in eval_ips.items() if v > 0}
+        self.evaluation = EvaluationSet(self.eval_ips)
+
+    def merged(self, exclude, shards: int = 8) -> Feed:
+        parts = []
+        shard = shard_of(self.df["value"].to_list(), shards)
+        eval_shard = shard_of(list(self.eval_ips), shards)
+        for index in range(shards):
+            evaluation = EvaluationSet({ip: v for (ip, v), s in zip(self.eval_ips.items(), eval_shard) if s == index})
+            rows = self.df[shard == index].reset_index(drop=True)
+            if rows.empty:
+                parts.append(empty_feed_part(evaluation, "score"))
+                continue
+            feed = Feed("feed", data=rows, size=100, sort_key="score", eval_ips=evaluation)
+            feed.exclude(exclude(rows))
+            parts.append(feed_part(feed, 100))
+        self.assertTrue(any(part["rows"].empty for part in parts))
+        return merge_feed_parts("feed", "score", parts, 100)
+
+    def unsharded(self, exclude) -> Feed:
+        feed = Feed("feed", data=self.df, size=100, sort_key="score", eval_ips=self.evaluation)
+        feed.exclude(exclude(self.df))
+        return feed
+
+    def assert_same_metrics(self, exclude):
+        merged, unsharded = self.merged(exclude), self.unsharded(exclude)
+        with np.errstate(invalid="ignore"):
+            merged.evaluate()
+            unsharded.evaluate()
+        self.assertEqual(merged.metrics.keys(), unsharded.metrics.keys())
+        for key, value in unsharded.metrics.items():
+            np.testing.assert_allclose(merged.metrics[key], value, err_msg=key)
+        return merged
+
+    def test_partially_excluded_feed_matches_unsharded(self):
+        self.assert_same_metrics(lambda rows: rows["score"] < 0.3)
+
+    def test_fully_excluded_feed_has_size_zero(self):
+        merged = self.assert_same_metrics(lambda rows: np.ones(len(rows), dtype=bool))
+        self.assertEqual(len(merged), 0)
+        self.assertEqual(merged.metrics["ip_tp"], 0)
+
+    def test_empty_part_has_feed_part_columns(self):
+        part = empty_feed_part(self.evaluation, "score", has_coa=True)
+        self.assertEqual(list(part["rows"].columns), ["value", "position", "interactions_on_eval_day", "score", "coa_score"])
+
+
+if __name__ == "__main__":
+    unittest.main()
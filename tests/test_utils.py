@@ -0,0 +1,42 @@
+import random
+import socket
+import unittest
+
+import numpy as np
+from models.utils import ipv4_to_int
+
+
+def inet_pton_int(value) -> int:
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, value), "big")
+    except (OSError, TypeError, ValueError):
+        return -1
+
+
+class Ipv4ToIntTest(unittest.TestCase):
+    def assert_matches_inet_pton(self, values):
+        np.testing.assert_array_equal(ipv4_to_int(values), [inet_pton_int(v) for v in values])
+
+    def test_edge_cases(self):
+        self.assert_matches_inet_pton(
+            ["0.0.0.0", "255.255.255.255", "1.2.3.4", "01.2.3.4", "1.2.3.04", "0.00.0.0", "256.1.1.1", "1.2.3.1234",
+             "1.2.3", "1.2.3.4.", ".1.2.3", "1..2.3", "1.2.3.4.5", " 1.2.3.4", "1.2.3.4 ", "", "0x1.2.3.4",
+             "2001:db8::1", "123.123.123.1234", "1111.1.1.1", "99999999999.1.1.1"]
+        )
+
+    def test_random_strings(self):
+        rng = random.Random(0)
+        values = ["".join(rng.choice("0123456789..") for _ in range(rng.randint(0, 17))) for _ in range(20000)]
+        values += [".".join(str(rng.choice([rng.randint(0, 300), rng.randint(0, 9)])) for _ in range(4)) for _ in range(20000)]
+        self.assert_matches_inet_pton(values)
+
+    def test_other_inputs(self):
+        self.assert_matches_inet_pton(["1.2.3.4", None, 5, float("nan"), "١.2.3.4"])
+        np.testing.assert_array_equal(ipv4_to_int(np.array(["10.0.0.1", "x"], dtype=object)), [167772161, -1])
+        np.testing.assert_array_equal(ipv4_to_int({"9.9.9.9": 1}.keys()), [151587081])
+        np.testing.assert_array_equal(ipv4_to_int(np.array([3, 4])), [3, 4])
+        self.assertEqual(len(ipv4_to_int([])), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,5 @@
 import argparse
+import time
 
 import pandas as pd
 from greedybear_utils import calculate_interaction_delta, read_dump
@@ -7,51 +8,200 @@ from models.model_definitions import MODEL_DEFINITIONS
 from models.utils import get_features
 
 
+def read_dated_dump(file_path: str, label: str) -> tuple[list[dict], str]:
+    print(f"loading {label}")
+    data = read_dump(file_path)
+    data_date = max(row["last_seen"] for row in data)
+    print(f"{label} is from {data_date}")
+    return data, data_date
+
+
+def label_training_data(training_data: list[dict], training_data_date: str, training_target: list[dict], training_df: pd.DataFrame = None) -> pd.DataFrame:
+    interaction_delta = calculate_interaction_delta(training_data, training_data_date, training_target)
+    if training_df is None:
+        training_df = get_features(training_data, training_data_date)
+    training_df["interactions_on_eval_day"] = training_df["value"].map(lambda ip: interaction_delta[ip])
+    return training_df
+
+
+def build_training_df(training_data_path: str, training_target_path: str) -> tuple[pd.DataFrame, str]:
+    """
+    Load a pair of GreedyBear dumps and build the feature frame used for training.
+
+    Args:
+        training_data_path: Path to the dump the features are extracted from
+        training_target_path: Path to the dump of the following day, used to derive the targets
+
+    Returns:
+        The training DataFrame including the 'interactions_on_eval_day' target column
+        and the date of the training data
+    """
+    training_data, training_data_date = read_dated_dump(training_data_path, "training data")
+    training_target, training_target_date = read_dated_dump(training_target_path, "training target")
+    assert training_data_date < training_target_date
+    return label_training_data(training_data, training_data_date, training_target), training_data_date
+
+
+class TrainingWindow:
+    """
+    Training data spanning multiple days that is streamed from disk one day at a time.
+
+    Every block pairs the dump of one day with the dump of the following day as training
+    target. Only two dumps and one feature frame are held in memory at any time, so memory
+    use does not grow with the length of the window.
+
+    Attributes:
+        dump_paths (list): Paths to the dumps of consecutive days, sorted by date
+    """
+
+    def __init__(self, dump_paths: list[str]):
+        assert len(dump_paths) > 1, "a training window needs at least two dumps"
+        self.dump_paths = dump_paths
+
+    def __len__(self) -> int:
+        return len(self.dump_paths) - 1
+
+    def __iter__(self):
+        training_data, training_data_date = read_dated_dump(self.dump_paths[0], "training data")
+        for target_path in self.dump_paths[1:]:
+            training_target, training_target_date = read_dated_dump(target_path, "training target")
+            assert training_data_date < training_target_date
+            yield label_training_data(training_data, training_data_date, training_target)
+            training_data, training_data_date = training_target, training_target_date
+
+
+def train(
+    training_data: pd.DataFrame | TrainingWindow,
+    search: bool = False,
+    warm_start: bool = False,
+    models: list = None,
+    negative_rate: float = 1.0,
+    early_stopping: bool = False,
+    time_budget: float = None,
+) -> list[dict]:
+    """
+    Train all trainable models on a prepared training DataFrame or a multi-day training window.
+
+    A training window is passed to the models block by block, so that every day gets about
+    an equal share of the final model. Boosted models train 1 / len(window) of their
+    iterations on the first block and add as many on every following block. Forests are
+    grown on the first block and replace 1 / len(window) of their trees, the oldest ones,
+    on every following block. Models that cannot continue from a previous artifact (see
+    MLModel.incremental) are trained on the last block only. Only the model trained on the
+    last block is saved, under the date of the last block.
+
+    Args:
+        training_data: DataFrame as returned by build_training_df or a TrainingWindow
+        search: If True, run a hyper parameter search instead of training
+        warm_start: If True, update the previously saved artifacts instead of training from scratch
+        models: Models to train, defaults to all models in MODEL_DEFINITIONS
+        negative_rate: Share of negative examples the classifiers are trained on
+        early_stopping: If True, stop adding trees once the recall AUC on a validation set plateaus
+        time_budget: Wall-clock budget in seconds per model and block for adding trees or running solver iterations
+
+    Returns:
+        One record per trained model with its name, the training time in seconds
+        and the recall AUC on the held-out test split (of the last block for windows)
+    """
+    if models is None:
+        models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS]
+    models = [m for m in models if m.trainable]
+    blocks = [training_data]
+    if isinstance(training_data, TrainingWindow):
+        assert not search, "hyper parameter search is not supported for training windows"
+        blocks = training_data
+        for model in models:
+            model.warm_start_fraction = 1 / len(training_data)
+            model.scratch_fraction = 1 / len(training_data)
+
+    results = {model.name: {"model": model.name, "seconds": 0.0} for model in models}
+    for idx, block in enumerate(blocks):
+        for model in models:
+            if not model.incremental and idx < len(blocks) - 1:
+                continue
+            model.training_date = block["last_seen"].max()
+            model.persist = idx == len(blocks) - 1
+            model.negative_rate = negative_rate
+            model.early_stopping = early_stopping
+            model.time_budget = time_budget
+            start = time.perf_counter()
+            results[model.name]["recall_auc"] = model.train(block, search, warm_start or idx > 0)
+            results[model.name]["seconds"] += time.perf_counter() - start
+    for model in models:
+        model.unsaved = None
+    return list(results.values())
+
+
 def run():
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=__doc__)
 
     parser.add_argument(
         "-d",
         "--training-data",
-        required=True,
         help="Path to the .json file containing the training data.",
     )
 
     parser.add_argument(
         "-t",
         "--training-target",
-        required=True,
         help="Path to the .json file containing the training targets.",
     )
 
+    parser.add_argument(
+        "-W",
+        "--training-window",
+        help="Paths to the .json files of consecutive days to train on, streamed from disk one day at a time. Replaces -d and -t.",
+        nargs="+",
+    )
+
     parser.add_argument(
         "--hyper-param-search",
         help="Triggers a random hyper parameter search for all trainable models with given data.",
         action="store_true",
     )
 
-    config = vars(parser.parse_args())
+    parser.add_argument(
+        "-w",
+        "--warm-start",
+        help="Update the previously trained models with the given data instead of training from scratch.",
+        action="store_true",
+    )
 
-    print("loading training data")
-    training_data = read_dump(config["training_data"])
-    training_data_date = max(row["last_seen"] for row in training_data)
-    print(f"training data is from {training_data_date}")
+    parser.add_argument(
+        "--negative-rate",
+        help="Train the classifiers on this share of negative examples only, weighting them accordingly.",
+        type=float,
+        default=1.0,
+    )
 
-    print("loading training target")
-    training_target = read_dump(config["training_target"])
-    training_target_date = max(row["last_seen"] for row in training_target)
-    print(f"training target is from {training_target_date}")
+    parser.add_argument(
+        "--early-stopping",
+        help="Stop adding trees once the recall AUC on a held-out validation set stops improving. The logistic regression is always fitted until its solver converges.",
+        action="store_true",
+    )
 
-    assert training_data_date < training_target_date
+    parser.add_argument(
+        "--time-budget",
+        help="Wall-clock budget in seconds per model for growing trees or, for the logistic regression, running solver iterations.",
+        type=float,
+    )
 
-    interaction_delta = calculate_interaction_delta(training_data, training_data_date, training_target)
-    training_df = get_features(training_data, training_data_date)
-    training_df["interactions_on_eval_day"] = training_df["value"].map(lambda ip: interaction_delta[ip])
+    config = vars(parser.parse_args())
 
-    models = [d.get("class", Model)(d) for d in MODEL_DEFINITIONS]
-    for model in models:
-        if model.trainable:
-            model.train(training_df, config["hyper_param_search"])
+    if config["training_window"]:
+        training_data = TrainingWindow(sorted(config["training_window"]))
+    elif config["training_data"] and config["training_target"]:
+        training_data, _ = build_training_df(config["training_data"], config["training_target"])
+    else:
+        parser.error("either --training-window or both --training-data and --training-target are required")
+    train(
+        training_data,
+        config["hyper_param_search"],
+        config["warm_start"],
+        negative_rate=config["negative_rate"],
+        early_stopping=config["early_stopping"],
+        time_budget=config["time_budget"],
+    )
 
 
 if __name__ == "__main__":